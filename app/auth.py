@@ -1,6 +1,12 @@
 import os
 import jwt
+import hmac
+import time
+import hashlib
+import functools
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from fastapi import HTTPException, status
 
@@ -10,6 +16,16 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 horas
 
+# Cache de tokens ya verificados: blake2b(token) -> (exp, usuario).
+# Evita repetir el HMAC en cada petición autenticada; cada entrada caduca con
+# el "exp" del propio token. Se guarda el hash, nunca el token en claro.
+TOKEN_CACHE_SIZE = 1024
+_token_cache: "OrderedDict[bytes, tuple[float, dict]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+def _token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     """Crea un token JWT"""
     to_encode = data.copy()
@@ -23,7 +39,17 @@ def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     return encoded_jwt
 
 def verify_token(token: str) -> dict:
-    """Verifica un token JWT"""
+    """Verifica un token JWT (con cache hasta su expiración)"""
+    key = _token_key(token)
+    with _token_cache_lock:
+        hit = _token_cache.get(key)
+        if hit is not None:
+            exp, user = hit
+            if exp > time.time():
+                _token_cache.move_to_end(key)
+                return dict(user)
+            del _token_cache[key]
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -32,7 +58,14 @@ def verify_token(token: str) -> dict:
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid token"
             )
-        return {"username": username}
+        user = {"username": username}
+        exp = payload.get("exp")
+        if exp is not None:
+            with _token_cache_lock:
+                _token_cache[key] = (float(exp), user)
+                if len(_token_cache) > TOKEN_CACHE_SIZE:
+                    _token_cache.popitem(last=False)
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -44,14 +77,24 @@ def verify_token(token: str) -> dict:
             detail="Invalid token"
         )
 
+@functools.lru_cache(maxsize=1)
+def _valid_credentials() -> tuple[bytes, bytes]:
+    # Se lee en la primera llamada (no al importar) para respetar el .env
+    # que main.py carga después de importar este módulo
+    return (
+        os.environ.get("AUTH_USERNAME", "admin").encode(),
+        os.environ.get("AUTH_PASSWORD", "admin").encode(),
+    )
+
 def authenticate_user(username: str, password: str) -> bool:
-    """Valida las credenciales del usuario"""
-    valid_username = os.environ.get("AUTH_USERNAME", "admin")
-    valid_password = os.environ.get("AUTH_PASSWORD", "admin")
-    
-    if username == valid_username and password == valid_password:
-        logger.info(f"User '{username}' authenticated successfully")
+    """Valida las credenciales del usuario (comparación en tiempo constante)"""
+    valid_username, valid_password = _valid_credentials()
+
+    # `&` y no `and`: se comparan siempre ambos campos
+    ok = hmac.compare_digest(username.encode(), valid_username) & hmac.compare_digest(password.encode(), valid_password)
+    if ok:
+        logger.info("User '%s' authenticated successfully", username)
         return True
     
-    logger.warning(f"Failed login attempt with username: {username}")
+    logger.warning("Failed login attempt with username: %s", username)
     return False
@@ -23,46 +23,33 @@ def convert_image(in_path, out_path):
         print(f"[INFO] Redimensionando {img.size} -> {(TARGET_W, TARGET_H)}")
         img = img.resize((TARGET_W, TARGET_H), resample=Image.NEAREST)
 
-    arr = np.array(img)
-
-    r = arr[:, :, 0]
-    g = arr[:, :, 1]
-    b = arr[:, :, 2]
+    # Planos contiguos por canal (SoA) en vez de vistas con stride 3 sobre HxWx3
+    r, g, b = (np.asarray(c) for c in img.split())
 
     # Clasificación robusta a blanco / negro / rojo
-    red_mask = (r > 160) & (g < 120) & (b < 120)
-    lum = (0.2126*r + 0.7152*g + 0.0722*b)
-    black_mask = (lum < 128) & (~red_mask)
-    white_mask = ~(red_mask | black_mask)
-
-    # Empaquetado bit a bit (MSB first)
+    # AND acumulado in-place: un único buffer booleano en vez de tres
+    red_mask = r > 160
+    np.logical_and(red_mask, g < 120, out=red_mask)
+    np.logical_and(red_mask, b < 120, out=red_mask)
+    lum = np.float32(0.2126)*r + np.float32(0.7152)*g + np.float32(0.0722)*b
+    # Índice de clase por píxel: 0 = blanco, 1 = negro, 2 = rojo (el rojo manda)
+    cls = np.where(red_mask, np.uint8(2), (lum < 128).view(np.uint8))
+
+    # Empaquetado bit a bit (MSB first); blanco => no se marca nada
     w, h = TARGET_W, TARGET_H
-    bytes_per_row = (w + 7) // 8
-
-    black_plane = bytearray(bytes_per_row * h)
-    red_plane   = bytearray(bytes_per_row * h)
-
-    for y in range(h):
-        row_off = y * bytes_per_row
-        for x in range(w):
-            bit = 7 - (x % 8)
-            idx = row_off + (x // 8)
-
-            if black_mask[y, x]:
-                black_plane[idx] |= (1 << bit)
-            elif red_mask[y, x]:
-                red_plane[idx] |= (1 << bit)
-            # blanco => no se marca nada
+    black_plane = np.packbits(cls == 1, axis=1, bitorder="big")
+    red_plane   = np.packbits(cls == 2, axis=1, bitorder="big")
 
     with open(out_path, "wb") as f:
         f.write(b"TRI1")
         f.write(struct.pack("<H", w))
         f.write(struct.pack("<H", h))
-        f.write(black_plane)
-        f.write(red_plane)
+        # Volcado directo desde el buffer de NumPy (sin copia a bytes)
+        black_plane.tofile(f)
+        red_plane.tofile(f)
 
     print(f"[OK] {in_path} -> {out_path}")
-    print(f"     Tamaño: {len(black_plane)+len(red_plane)+8} bytes")
+    print(f"     Tamaño: {black_plane.nbytes+red_plane.nbytes+8} bytes")
 
 def main():
     if len(sys.argv) < 2:
@@ -1,9 +1,11 @@
 import argparse
+import functools
 import os
 import struct
 from dataclasses import dataclass
 
 import numpy as np
+from numba import njit, prange
 from PIL import Image, ImageOps, ImageEnhance
 
 import matplotlib.pyplot as plt
@@ -37,6 +39,9 @@ class Params:
     red_g_max: int
     red_b_max: int
 
+    # Barrido serpentina en Floyd–Steinberg
+    serpentine: bool = True
+
 
 def clamp_uint8(a: np.ndarray) -> np.ndarray:
     return np.clip(a, 0, 255).astype(np.uint8)
@@ -62,18 +67,55 @@ def to_grayscale(img: Image.Image, p: Params) -> np.ndarray:
     return arr
 
 
+@njit(["void(i4[:, :])", "void(i8[:, :])", "void(f4[:, :])", "void(f8[:, :])"], cache=True, boundscheck=False)
+def _accumulate_rows(ii):
+    # ii[i, :] += ii[i-1, :]; el bucle interno es contiguo y se vectoriza
+    for i in range(1, ii.shape[0]):
+        for j in range(ii.shape[1]):
+            ii[i, j] += ii[i - 1, j]
+
+
 def integral_image(a: np.ndarray) -> np.ndarray:
-    # padded integral image for fast box sums
-    ii = np.cumsum(np.cumsum(a, axis=0), axis=1)
-    ii = np.pad(ii, ((1, 0), (1, 0)), mode="constant", constant_values=0)
+    # padded integral image for fast box sums, built in a single (H+1)x(W+1) buffer
+    h, w = a.shape
+    ii = np.empty((h + 1, w + 1), dtype=a.dtype)
+    ii[0, :] = 0
+    ii[:, 0] = 0
+    np.cumsum(a, axis=1, out=ii[1:, 1:])
+    _accumulate_rows(ii)
     return ii
 
 
-def box_sum(ii: np.ndarray, r0: int, c0: int, r1: int, c1: int) -> np.ndarray:
-    # sum over [r0,r1) x [c0,c1)
+def box_sum(ii: np.ndarray, r0, c0, r1, c1) -> np.ndarray:
+    # sum over [r0,r1) x [c0,c1); bounds may be ints or broadcastable index arrays
     return ii[r1, c1] - ii[r0, c1] - ii[r1, c0] + ii[r0, c0]
 
 
+# Filas por banda en adaptive_sauvola
+_SAUVOLA_BAND = 64
+
+
+def _readonly(a: np.ndarray) -> np.ndarray:
+    a.setflags(write=False)
+    return a
+
+
+@functools.lru_cache(maxsize=8)
+def _window_coords(h: int, w: int, r: int):
+    """
+    Window bounds per row (column vector) and per column (row vector);
+    they broadcast to HxW so every box sum is a single fancy-index lookup.
+    Cached per (h, w, r): arrays are shared, hence read-only.
+    """
+    ys = np.arange(h)[:, None]
+    xs = np.arange(w)[None, :]
+    y0 = np.clip(ys - r, 0, h)
+    y1 = np.clip(ys + r + 1, 0, h)
+    x0 = np.clip(xs - r, 0, w)
+    x1 = np.clip(xs + r + 1, 0, w)
+    return _readonly(y0), _readonly(y1), _readonly(x0), _readonly(x1)
+
+
 def adaptive_sauvola(gray: np.ndarray, window: int, k: float) -> np.ndarray:
     """
     Sauvola thresholding:
@@ -84,127 +126,199 @@ def adaptive_sauvola(gray: np.ndarray, window: int, k: float) -> np.ndarray:
     r = window // 2
     h, w = gray.shape
 
-    g = gray.astype(np.float32)
+    # Integrales enteras: exactas y sin float64. La de la suma va en int32 a
+    # cualquier tamaño: aunque la integral desborde (255·H·W > 2**31) el
+    # desbordamiento es módulo 2**32 y box_sum resta en int32 *antes* del cast a
+    # float32, así que cada suma de ventana (<= 255·window², muy por debajo de
+    # 2**31) sale exacta. No mover el cast antes de la resta. La de cuadrados va
+    # en int64. Una integral float32 perdería precisión ya con 255·H·W > 2**24.
+    g = gray.astype(np.int32)
     ii = integral_image(g)
-    ii2 = integral_image(g * g)
-
-    # build coordinate grids
-    ys = np.arange(h)
-    xs = np.arange(w)
-    y0 = np.clip(ys - r, 0, h)
-    y1 = np.clip(ys + r + 1, 0, h)
-    x0 = np.clip(xs - r, 0, w)
-    x1 = np.clip(xs + r + 1, 0, w)
+    ii2 = integral_image(g.astype(np.int64) * g)
 
-    # compute mean and std with separable broadcasting
-    # sums for each row/col window using ii slicing:
-    # We'll compute using loops over one axis to keep it simple & reliable.
-    mean = np.zeros((h, w), dtype=np.float32)
-    var = np.zeros((h, w), dtype=np.float32)
+    y0, y1, x0, x1 = _window_coords(h, w, r)
 
-    for y in range(h):
-        r0, r1 = y0[y], y1[y]
-        # sums over x windows for this row band
-        # we compute per x using ii; still O(hw) but ok for 480x670
-        for x in range(w):
-            c0, c1 = x0[x], x1[x]
-            area = (r1 - r0) * (c1 - c0)
-            s = box_sum(ii, r0, c0, r1, c1)
-            s2 = box_sum(ii2, r0, c0, r1, c1)
-            m = s / area
-            v = (s2 / area) - (m * m)
-            if v < 0:
-                v = 0.0
-            mean[y, x] = m
-            var[y, x] = v
-
-    std = np.sqrt(var)
+    # Stats en bandas de filas: los temporales (mean, var, T) son de
+    # _SAUVOLA_BAND x W y caben en L2 en lugar de recorrer HxW varias veces
     R = 128.0
-    T = mean * (1.0 + k * ((std / R) - 1.0))
-    T = np.clip(T, 0, 255)
-
-    # black if gray < T
-    return (gray.astype(np.float32) < T)
+    out = np.empty((h, w), dtype=bool)
+    for b0 in range(0, h, _SAUVOLA_BAND):
+        b1 = min(b0 + _SAUVOLA_BAND, h)
+        by0, by1 = y0[b0:b1], y1[b0:b1]
+
+        area = ((by1 - by0) * (x1 - x0)).astype(np.float32)
+        s = box_sum(ii, by0, x0, by1, x1).astype(np.float32)
+        s2 = box_sum(ii2, by0, x0, by1, x1).astype(np.float32)
+        mean = s / area
+        var = np.maximum((s2 / area) - (mean * mean), 0.0)
+
+        std = np.sqrt(var)
+        T = mean * (1.0 + k * ((std / R) - 1.0))
+        T = np.clip(T, 0, 255)
+
+        # black if gray < T
+        np.less(gray[b0:b1], T, out=out[b0:b1])
+    return out
 
 
 def fixed_threshold(gray: np.ndarray, t: int) -> np.ndarray:
     return gray < t
 
 
+@njit("b1[:, :](u1[:, :])", parallel=True, cache=True, boundscheck=False)
+def _text_mask_kernel(gray):
+    h, w = gray.shape
+    mag2 = np.empty((h, w), dtype=np.int32)
+    row_max = np.zeros(h, dtype=np.int32)
+
+    # 1. Sobel 3x3 (bordes replicados, como mode="reflect" de scipy) y máximo
+    # por fila de la magnitud AL CUADRADO (cabe en int32: <= 2·1020²)
+    for y in prange(h):
+        ym = max(y - 1, 0)
+        yp = min(y + 1, h - 1)
+        m = np.int32(0)
+        for x in range(w):
+            xm = max(x - 1, 0)
+            xp = min(x + 1, w - 1)
+            sx = (np.int32(gray[ym, xp]) + 2 * np.int32(gray[y, xp]) + np.int32(gray[yp, xp])
+                  - np.int32(gray[ym, xm]) - 2 * np.int32(gray[y, xm]) - np.int32(gray[yp, xm]))
+            sy = (np.int32(gray[yp, xm]) + 2 * np.int32(gray[yp, x]) + np.int32(gray[yp, xp])
+                  - np.int32(gray[ym, xm]) - 2 * np.int32(gray[ym, x]) - np.int32(gray[ym, xp]))
+            v = np.int32(sx * sx + sy * sy)
+            mag2[y, x] = v
+            if v > m:
+                m = v
+        row_max[y] = m
+
+    # 2. Texto = píxeles extremos (muy oscuros o muy claros) + bordes fuertes.
+    # |g|/max > 0.3  <=>  |g|² > 0.09·max²: sin sqrt ni normalización
+    limit2 = 0.09 * row_max.max()
+    cand = np.empty((h, w), dtype=np.bool_)
+    for y in prange(h):
+        for x in range(w):
+            v = gray[y, x]
+            cand[y, x] = (v < 100 or v > 200) and mag2[y, x] > limit2
+
+    # 3. Dilatación de 1 iteración con conectividad 4 (fuera de la imagen = False)
+    out = np.empty((h, w), dtype=np.bool_)
+    for y in prange(h):
+        for x in range(w):
+            out[y, x] = (cand[y, x]
+                         or (y > 0 and cand[y - 1, x])
+                         or (y + 1 < h and cand[y + 1, x])
+                         or (x > 0 and cand[y, x - 1])
+                         or (x + 1 < w and cand[y, x + 1]))
+    return out
+
+
 def detect_text_regions(gray: np.ndarray) -> np.ndarray:
     """
     Detecta regiones de TEXTO renderizado (no fotografías).
-    Usa detección de bordes para identificar texto con características nítidas.
+    Usa detección de bordes para identificar texto con características nítidas:
+    píxeles extremos (<100 o >200) con gradiente Sobel > 30% del máximo,
+    dilatados una iteración (conectividad 4) para conectar caracteres.
     Retorna máscara booleana: True = es texto (no aplicar dithering)
     """
-    from scipy import ndimage
-    from scipy.ndimage import sobel
-    
-    # 1. Detectar píxeles muy oscuros o muy claros (candidatos a texto)
-    is_very_dark = gray < 100
-    is_very_light = gray > 200
-    extreme_values = is_very_dark | is_very_light
-    
-    # 2. Calcular gradientes (bordes) usando Sobel
-    sx = sobel(gray.astype(np.float32), axis=1)
-    sy = sobel(gray.astype(np.float32), axis=0)
-    edge_magnitude = np.sqrt(sx**2 + sy**2)
-    
-    # 3. Texto tiene bordes MUY definidos (gradiente alto)
-    # Normalizar edge_magnitude
-    if edge_magnitude.max() > 0:
-        edge_magnitude = edge_magnitude / edge_magnitude.max()
-    
-    strong_edges = edge_magnitude > 0.3  # Bordes fuertes
-    
-    # 4. Texto = píxeles extremos + bordes fuertes
-    # Esto excluye fotos con gradientes suaves
-    text_candidates = extreme_values & strong_edges
-    
-    # 5. Expansión morfológica pequeña (1 iteración)
-    # Solo para conectar caracteres, no para expandir mucho
-    struct = ndimage.generate_binary_structure(2, 1)  # Conectividad 4
-    text_expanded = ndimage.binary_dilation(text_candidates, structure=struct, iterations=1)
-    
-    return text_expanded
+    return _text_mask_kernel(np.ascontiguousarray(gray, dtype=np.uint8))
+
+
+# Constantes float32: los kernels operan enteramente en float32 (sin
+# promociones implícitas a float64 dentro del bucle)
+_F32_0 = np.float32(0.0)
+_F32_128 = np.float32(128.0)
+_F32_255 = np.float32(255.0)
+_FS_W_R = np.float32(7.0 / 16.0)
+_FS_W_BL = np.float32(3.0 / 16.0)
+_FS_W_B = np.float32(5.0 / 16.0)
+_FS_W_BR = np.float32(1.0 / 16.0)
+_ATK_W = np.float32(1.0 / 8.0)
+
+# Firmas explícitas: numba compila al importar (y cachea en disco), así la
+# latencia del JIT no cae en la primera conversión.
+@njit("b1[:, :](f4[:, :], b1[:, :], i8, i8, b1)", cache=True, boundscheck=False)
+def _fs_kernel(a, text_mask, h, w, serpentine):
+    out = np.empty((h, w), dtype=np.bool_)
+    for y in range(h):
+        # Serpentina: en filas impares se recorre de derecha a izquierda y el
+        # kernel se refleja (7/16 va a x-1, 3/16 abajo a la derecha...)
+        if serpentine and (y & 1):
+            x = w - 1
+            step = -1
+        else:
+            x = 0
+            step = 1
+        for _ in range(w):
+            old = a[y, x]
+            black = old < _F32_128
+            out[y, x] = black
+
+            # Si es texto, umbral binario directo: NO difundir error
+            if not text_mask[y, x]:
+                err = old - (_F32_0 if black else _F32_255)
+                err_r = err * _FS_W_R
+                err_bl = err * _FS_W_BL
+                err_b = err * _FS_W_B
+                err_br = err * _FS_W_BR
+                xn = x + step
+                xp = x - step
+                if 0 <= xn < w:
+                    a[y, xn] += err_r
+                if y + 1 < h:
+                    if 0 <= xp < w:
+                        a[y + 1, xp] += err_bl
+                    a[y + 1, x] += err_b
+                    if 0 <= xn < w:
+                        a[y + 1, xn] += err_br
+            x += step
+    return out
 
 
-def dither_fs(gray: np.ndarray, text_mask: np.ndarray = None) -> np.ndarray:
-    """
-    Floyd–Steinberg dithering con protección de texto: returns bool mask (True=black)
-    Si text_mask es proporcionado, no aplica dithering en esas regiones (usa umbral simple).
-    """
-    a = gray.astype(np.float32).copy()
-    h, w = a.shape
-    
-    # Si no hay máscara de texto, crear una vacía
-    if text_mask is None:
-        text_mask = np.zeros((h, w), dtype=bool)
-    
+@njit("b1[:, :](f4[:, :], b1[:, :], i8, i8)", cache=True, boundscheck=False)
+def _atkinson_kernel(a, text_mask, h, w):
+    out = np.empty((h, w), dtype=np.bool_)
     for y in range(h):
         for x in range(w):
             old = a[y, x]
-            
-            # Si es texto, usar umbral binario directo (sin difusión de error)
+            black = old < _F32_128
+            out[y, x] = black
+
             if text_mask[y, x]:
-                new = 0.0 if old < 128 else 255.0
-                a[y, x] = new
-                # NO difundir error en regiones de texto
                 continue
-            
-            # Para imágenes: aplicar dithering normal
-            new = 0.0 if old < 128 else 255.0
-            err = old - new
-            a[y, x] = new
+
+            # Seis vecinos desenrollados, cada uno recibe err/8:
+            #   x  1  1
+            #   1  1  1
+            #      1
+            err = (old - (_F32_0 if black else _F32_255)) * _ATK_W
             if x + 1 < w:
-                a[y, x + 1] += err * 7 / 16
+                a[y, x + 1] += err
+            if x + 2 < w:
+                a[y, x + 2] += err
             if y + 1 < h:
                 if x > 0:
-                    a[y + 1, x - 1] += err * 3 / 16
-                a[y + 1, x] += err * 5 / 16
+                    a[y + 1, x - 1] += err
+                a[y + 1, x] += err
                 if x + 1 < w:
-                    a[y + 1, x + 1] += err * 1 / 16
-    return a < 128
+                    a[y + 1, x + 1] += err
+            if y + 2 < h:
+                a[y + 2, x] += err
+    return out
+
+
+def dither_fs(gray: np.ndarray, text_mask: np.ndarray = None, serpentine: bool = True) -> np.ndarray:
+    """
+    Floyd–Steinberg dithering con protección de texto: returns bool mask (True=black)
+    Si text_mask es proporcionado, no aplica dithering en esas regiones (usa umbral simple).
+    serpentine alterna el sentido del barrido por fila para evitar vetas direccionales.
+    """
+    a = gray.astype(np.float32)
+    h, w = a.shape
+
+    # Si no hay máscara de texto, crear una vacía
+    if text_mask is None:
+        text_mask = np.zeros((h, w), dtype=bool)
+
+    return _fs_kernel(a, text_mask, h, w, serpentine)
 
 
 def dither_atkinson(gray: np.ndarray, text_mask: np.ndarray = None) -> np.ndarray:
@@ -212,35 +326,25 @@ def dither_atkinson(gray: np.ndarray, text_mask: np.ndarray = None) -> np.ndarra
     Atkinson dithering con protección de texto: returns bool mask (True=black)
     Si text_mask es proporcionado, no aplica dithering en esas regiones (usa umbral simple).
     """
-    a = gray.astype(np.float32).copy()
+    a = gray.astype(np.float32)
     h, w = a.shape
-    
+
     # Si no hay máscara de texto, crear una vacía
     if text_mask is None:
         text_mask = np.zeros((h, w), dtype=bool)
-    
+
+    return _atkinson_kernel(a, text_mask, h, w)
+
+
+@njit("b1[:, :](u1[:, :, :], i8, i8, i8)", cache=True, boundscheck=False)
+def _red_kernel(rgb, r_min, g_max, b_max):
+    # Una sola pasada sobre la imagen: sin máscaras intermedias por canal
+    h, w = rgb.shape[0], rgb.shape[1]
+    out = np.empty((h, w), dtype=np.bool_)
     for y in range(h):
         for x in range(w):
-            old = a[y, x]
-            
-            # Si es texto, usar umbral binario directo (sin difusión de error)
-            if text_mask[y, x]:
-                new = 0.0 if old < 128 else 255.0
-                a[y, x] = new
-                # NO difundir error en regiones de texto
-                continue
-            
-            # Para imágenes: aplicar dithering normal
-            new = 0.0 if old < 128 else 255.0
-            err = (old - new) / 8.0
-            a[y, x] = new
-            # distribute to neighbors
-            for dx, dy in [(1,0), (2,0), (-1,1), (0,1), (1,1), (0,2)]:
-                xx = x + dx
-                yy = y + dy
-                if 0 <= xx < w and 0 <= yy < h:
-                    a[yy, xx] += err
-    return a < 128
+            out[y, x] = (rgb[y, x, 0] >= r_min) and (rgb[y, x, 1] <= g_max) and (rgb[y, x, 2] <= b_max)
+    return out
 
 
 def detect_red(rgb: np.ndarray, p: Params) -> np.ndarray:
@@ -248,36 +352,23 @@ def detect_red(rgb: np.ndarray, p: Params) -> np.ndarray:
     Simple red detection (for tricolor panels):
       red if R high and G/B low enough.
     """
-    r = rgb[:, :, 0]
-    g = rgb[:, :, 1]
-    b = rgb[:, :, 2]
-    return (r >= p.red_r_min) & (g <= p.red_g_max) & (b <= p.red_b_max)
+    return _red_kernel(rgb, p.red_r_min, p.red_g_max, p.red_b_max)
 
 
-def pack_1bpp(mask: np.ndarray) -> bytes:
+def pack_1bpp(mask: np.ndarray) -> np.ndarray:
     """
     mask: HxW bool; True=1 (black/red pixel)
-    pack MSB-first per byte.
+    pack MSB-first per byte (np.packbits zero-pads the last byte of each row).
+    Returns the HxBPR uint8 array; write_tri streams it without a bytes copy.
     """
-    h, w = mask.shape
-    bpr = (w + 7) // 8
-    out = np.zeros((h, bpr), dtype=np.uint8)
-    for y in range(h):
-        row = mask[y]
-        for x in range(w):
-            if row[x]:
-                out[y, x // 8] |= (1 << (7 - (x % 8)))
-    return out.tobytes()
+    return np.packbits(mask, axis=1, bitorder="big")
 
 
 def unpack_1bpp(buf: bytes, w: int, h: int) -> np.ndarray:
     bpr = (w + 7) // 8
     a = np.frombuffer(buf, dtype=np.uint8).reshape((h, bpr))
-    out = np.zeros((h, w), dtype=bool)
-    for y in range(h):
-        for x in range(w):
-            out[y, x] = (a[y, x // 8] >> (7 - (x % 8))) & 1
-    return out
+    # unpackbits yields 0/1 uint8: reinterpret as bool without copying
+    return np.unpackbits(a, axis=1, count=w, bitorder="big").view(bool)
 
 
 def convert_image(img_path: str, p: Params):
@@ -312,14 +403,22 @@ def convert_image(img_path: str, p: Params):
 
     # If a pixel is red, we prefer not to also mark it black.
     # (You can change this if your panel wants black+red combined.)
-    gray_no_red = gray.copy()
-    gray_no_red[red_mask] = 255  # force white in BW plane where red is set
+    # Force white in BW plane where red is set (one fused pass; no-op without red)
+    if p.red_mode == "auto":
+        gray_no_red = np.where(red_mask, np.uint8(255), gray)
+    else:
+        gray_no_red = gray
 
     # PROTECCIÓN DE TEXTO: detectar regiones de texto para evitar procesamiento agresivo
     text_mask = detect_text_regions(gray_no_red)
 
-    if p.dither == "fs":
-        black_mask = dither_fs(gray_no_red, text_mask=text_mask)
+    if p.dither == "fs" and not p.serpentine and not text_mask.any():
+        # Sin texto que proteger: Floyd–Steinberg nativo de PIL (C, barrido L→R).
+        # "1" guarda True=blanco, así que se invierte para True=black.
+        fs_img = Image.fromarray(gray_no_red).convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+        black_mask = ~np.asarray(fs_img, dtype=bool)
+    elif p.dither == "fs":
+        black_mask = dither_fs(gray_no_red, text_mask=text_mask, serpentine=p.serpentine)
     elif p.dither == "atkinson":
         black_mask = dither_atkinson(gray_no_red, text_mask=text_mask)
     else:
@@ -329,11 +428,14 @@ def convert_image(img_path: str, p: Params):
         else:
             image_mask = fixed_threshold(gray_no_red, p.threshold)
         
-        # Para regiones de texto: usar umbral binario simple (128)
-        text_binary = gray_no_red < 128
-        
-        # Combinar: usar umbral simple en texto, método adaptativo en imágenes
-        black_mask = np.where(text_mask, text_binary, image_mask)
+        if text_mask.any():
+            # Para regiones de texto: usar umbral binario simple (128)
+            text_binary = gray_no_red < 128
+
+            # Combinar: usar umbral simple en texto, método adaptativo en imágenes
+            black_mask = np.where(text_mask, text_binary, image_mask)
+        else:
+            black_mask = image_mask
 
     # Planes
     black_plane = pack_1bpp(black_mask)
@@ -341,13 +443,21 @@ def convert_image(img_path: str, p: Params):
 
     return img, gray, black_mask, red_mask, black_plane, red_plane
 
-def write_tri(out_path: str, w: int, h: int, black_plane: bytes, red_plane: bytes):
+def _write_plane(f, plane) -> None:
+    # ndarray (pack_1bpp) se vuelca directo desde su buffer; bytes tal cual
+    if hasattr(plane, "tofile"):
+        plane.tofile(f)
+    else:
+        f.write(plane)
+
+
+def write_tri(out_path: str, w: int, h: int, black_plane, red_plane):
     with open(out_path, "wb") as f:
         f.write(MAGIC)
         f.write(struct.pack("<H", w))
         f.write(struct.pack("<H", h))
-        f.write(black_plane)
-        f.write(red_plane)
+        _write_plane(f, black_plane)
+        _write_plane(f, red_plane)
 
 
 def read_tri(tri_path: str):
@@ -404,6 +514,8 @@ def main():
 
     # Dither
     ap.add_argument("--dither", choices=["none", "fs", "atkinson"], default="fs")
+    ap.add_argument("--no-serpentine", dest="serpentine", action="store_false",
+                    help="Scan every row left-to-right in Floyd–Steinberg")
 
     # Red
     ap.add_argument("--red-mode", choices=["auto", "none"], default="none")
@@ -442,6 +554,7 @@ def main():
         method=args.method, threshold=args.threshold,
         adaptive_window=args.adaptive_window, adaptive_k=args.adaptive_k,
         dither=args.dither,
+        serpentine=args.serpentine,
         red_mode=args.red_mode,
         red_r_min=args.red_r_min, red_g_max=args.red_g_max, red_b_max=args.red_b_max,
     )
@@ -454,7 +567,7 @@ def main():
         out = base + ".tri"
 
     write_tri(out, p.width, p.height, black_plane, red_plane)
-    print(f"OK -> {out}  (planes: {len(black_plane)}B + {len(red_plane)}B)")
+    print(f"OK -> {out}  (planes: {black_plane.nbytes}B + {red_plane.nbytes}B)")
 
     if args.preview:
         preview = render_preview(p.width, p.height, black_mask, red_mask)
@@ -464,47 +577,44 @@ def main():
 import numpy as np
 from PIL import Image, ImageOps
 
+# Matriz de Bayer 4x4
+# Esta matriz define el "patrón" o la textura que verás.
+# Los números indican el umbral de brillo para encender el píxel.
+# Normalizada a 0..255 (x 255/16) y truncada a uint8: para píxeles enteros
+# `p > floor(t)` equivale a `p > t` porque ningún umbral salvo 0 es entero.
+_BAYER_4_U8 = (np.array([
+    [ 0,  8,  2, 10],
+    [12,  4, 14,  6],
+    [ 3, 11,  1,  9],
+    [15,  7, 13,  5]
+]) * (255.0 / 16.0)).astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=8)
+def _bayer_threshold_map(h: int, w: int) -> np.ndarray:
+    """Mapa de umbral Bayer HxW uint8, cacheado por tamaño (compartido: solo lectura)."""
+    # Indexado modular (& 3 == % 4) en lugar de np.tile + recorte
+    return _readonly(_BAYER_4_U8[np.arange(h)[:, None] & 3, np.arange(w) & 3])
+
+
 def bayer_dithering(img):
     # 1. Cargar imagen y pasar a Escala de Grises
     img = img.convert("L")  # Convertir a escala de grises
     
     # Convertimos la imagen a un array de números (matriz de píxeles)
-    img_array = np.array(img, dtype=float)
+    img_array = np.asarray(img, dtype=np.uint8)
     
-    # 2. Definir la Matriz de Bayer 4x4
-    # Esta matriz define el "patrón" o la textura que verás.
-    # Los números indican el umbral de brillo para encender el píxel.
-    bayer_matrix = np.array([
-        [ 0,  8,  2, 10],
-        [12,  4, 14,  6],
-        [ 3, 11,  1,  9],
-        [15,  7, 13,  5]
-    ])
-    
-    # Normalizamos la matriz:
-    # La matriz original va de 0 a 15. La imagen va de 0 a 255.
-    # Multiplicamos para escalar los valores.
-    bayer_matrix = bayer_matrix * (255.0 / 16.0)
-    
-    # 3. "Enbaldosar" la matriz (Tiling)
-    # Repetimos la matriz 4x4 hasta cubrir toda la imagen
+    # 2-3. Mapa de umbral Bayer del tamaño de la imagen (cacheado por tamaño)
     h, w = img_array.shape
-    # Creamos una rejilla del tamaño de la imagen repitiendo la matriz pequeña
-    rep_h = int(np.ceil(h / 4))
-    rep_w = int(np.ceil(w / 4))
-    
-    # Creamos la máscara de umbral completa
-    threshold_map = np.tile(bayer_matrix, (rep_h, rep_w))
-    # Recortamos por si sobra un poco en los bordes
-    threshold_map = threshold_map[:h, :w]
+    threshold_map = _bayer_threshold_map(h, w)
     
     # 4. Aplicar la comparación (El Dithering en sí)
     # Si el píxel de la imagen es más brillante que el valor de la matriz -> Blanco (255)
     # Si no -> Negro (0)
-    result_array = np.where(img_array > threshold_map, 255, 0)
+    result_array = np.where(img_array > threshold_map, np.uint8(255), np.uint8(0))
     
     # 5. Guardar imagen
-    result_img = Image.fromarray(result_array.astype('uint8'))
+    result_img = Image.fromarray(result_array)
     return result_img 
 
 
@@ -1,11 +1,18 @@
 
 from __future__ import annotations
+import functools
 import numpy as np
+from numba import njit
 from PIL import Image
 
 import numpy as np
 from PIL import Image
 
+def _dark_mask(rgb: np.ndarray, thresh: int) -> np.ndarray:
+    """Luma rápida en sRGB (suficiente para segmentar fondo oscuro) <= thresh"""
+    luma = (0.2126*rgb[...,0] + 0.7152*rgb[...,1] + 0.0722*rgb[...,2]).astype(np.float32)
+    return luma <= thresh
+
 def remove_background_floodfill(
     img_pil: Image.Image,
     bg_luma_thresh: int = 30,   # 0..255, "qué tan oscuro consideras fondo"
@@ -17,55 +24,47 @@ def remove_background_floodfill(
     Devuelve imagen con fondo blanco o con alpha=0 si make_transparent=True.
     """
 
-    rgb = np.array(img_pil.convert("RGB"), dtype=np.uint8)
-    h, w = rgb.shape[:2]
+    # Vista de solo lectura sobre los bytes de la imagen convertida (una sola copia)
+    rgb_img = img_pil.convert("RGB")
+    w, h = rgb_img.size
+    rgb = np.frombuffer(rgb_img.tobytes(), dtype=np.uint8).reshape(h, w, 3)
 
-    # Luma rápida en sRGB (suficiente para segmentar fondo oscuro)
-    luma = (0.2126*rgb[...,0] + 0.7152*rgb[...,1] + 0.0722*rgb[...,2]).astype(np.float32)
+    # Sin ningún píxel oscuro en el borde no hay semillas: nada que quitar
+    border = np.concatenate((rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]))
+    if not _dark_mask(border, bg_luma_thresh).any():
+        return rgb_img.convert("RGBA") if make_transparent else rgb_img
 
     # Candidatos a fondo: muy oscuros
-    bg_candidate = luma <= bg_luma_thresh
+    bg_candidate = _dark_mask(rgb, bg_luma_thresh)
 
-    # Flood-fill (4-conectividad) desde bordes SOLO a través de bg_candidate
-    bg = np.zeros((h, w), dtype=bool)
+    # Flood-fill (4-conectividad) desde bordes SOLO a través de bg_candidate.
+    # Semillas: candidatos en el borde; binary_propagation (C) las expande
+    # dentro de la máscara hasta converger.
+    from scipy import ndimage
 
-    stack = []
-    # Añadir borde
-    for x in range(w):
-        if bg_candidate[0, x]: stack.append((0, x))
-        if bg_candidate[h-1, x]: stack.append((h-1, x))
-    for y in range(h):
-        if bg_candidate[y, 0]: stack.append((y, 0))
-        if bg_candidate[y, w-1]: stack.append((y, w-1))
-
-    while stack:
-        y, x = stack.pop()
-        if bg[y, x]:
-            continue
-        if not bg_candidate[y, x]:
-            continue
-        bg[y, x] = True
-
-        if y > 0: stack.append((y-1, x))
-        if y+1 < h: stack.append((y+1, x))
-        if x > 0: stack.append((y, x-1))
-        if x+1 < w: stack.append((y, x+1))
+    seed = np.zeros((h, w), dtype=bool)
+    seed[0, :] = bg_candidate[0, :]
+    seed[-1, :] = bg_candidate[-1, :]
+    seed[:, 0] = bg_candidate[:, 0]
+    seed[:, -1] = bg_candidate[:, -1]
+    struct = ndimage.generate_binary_structure(2, 1)  # Conectividad 4
+    bg = ndimage.binary_propagation(seed, structure=struct, mask=bg_candidate)
 
     # (Opcional) Feather simple para suavizar borde: dilatación ligera del bg
+    # (cruz 4-conectada repetida `feather` veces, en C y sin temporales por paso)
     if feather > 0:
-        bg2 = bg.copy()
-        for _ in range(feather):
-            b = bg2
-            bg2 = b | np.roll(b,1,0) | np.roll(b,-1,0) | np.roll(b,1,1) | np.roll(b,-1,1)
-        bg = bg2
+        bg = ndimage.binary_dilation(bg, structure=struct, iterations=feather)
 
     if make_transparent:
-        rgba = np.dstack([rgb, (~bg).astype(np.uint8)*255])
+        # Un único buffer RGBA: color copiado y alfa escrito en su sitio
+        rgba = np.empty((h, w, 4), dtype=np.uint8)
+        rgba[..., :3] = rgb
+        np.multiply(np.logical_not(bg), 255, out=rgba[..., 3], casting="unsafe")
         return Image.fromarray(rgba, mode="RGBA")
     else:
-        out = rgb.copy()
-        out[bg] = 255  # fondo a blanco puro
-        return Image.fromarray(out, mode="RGB")
+        # rgb_img es copia propia (convert): fondo a blanco puro en su sitio
+        rgb_img.paste((255, 255, 255), mask=Image.fromarray(bg))
+        return rgb_img
 
 
 
@@ -81,13 +80,16 @@ def linear_to_srgb(u: np.ndarray) -> np.ndarray:
     a = 0.055
     return np.where(u <= 0.0031308, 12.92 * u, (1 + a) * (u ** (1/2.4)) - a)
 
+# uint8 sRGB -> linear float32: 256 entradas precalculadas, así la conversión
+# por píxel es un simple gather en vez de where + pow
+_SRGB2LIN_LUT = srgb_to_linear(np.arange(256, dtype=np.float32) / 255.0).astype(np.float32)
+
 def rgb_to_luma_linear(img: np.ndarray) -> np.ndarray:
     """
     img uint8 RGB -> luma in linear space [0,1]
     Using Rec.709 coefficients on linear RGB.
     """
-    u = img.astype(np.float32) / 255.0
-    lin = srgb_to_linear(u)
+    lin = _SRGB2LIN_LUT[img]
     # Rec.709 / sRGB primaries luma
     return 0.2126 * lin[..., 0] + 0.7152 * lin[..., 1] + 0.0722 * lin[..., 2]
 
@@ -98,6 +100,13 @@ def apply_contrast_curve(x: np.ndarray, contrast: float = 1.0, mid: float = 0.5)
     """
     return np.clip((x - mid) * contrast + mid, 0.0, 1.0)
 
+@functools.lru_cache(maxsize=16)
+def _srgb2lin_contrast_lut(contrast: float, mid: float = 0.5) -> np.ndarray:
+    """LUT uint8 sRGB -> linear con el contraste ya aplicado (solo lectura)."""
+    lut = apply_contrast_curve(_SRGB2LIN_LUT, contrast=contrast, mid=mid).astype(np.float32)
+    lut.setflags(write=False)
+    return lut
+
 # ---------- Ordered dither (Bayer) ----------
 
 _BAYER_8 = (1/64.0) * np.array([
@@ -111,106 +120,162 @@ _BAYER_8 = (1/64.0) * np.array([
     [42, 26, 38, 22, 41, 25, 37, 21],
 ], dtype=np.float32)
 
+@njit("b1[:, ::1](f4[:, ::1], f8)", cache=True, boundscheck=False)
+def _bayer_kernel(lin, off):
+    # Umbral y comparación fusionados en una pasada: la matriz 8x8 se indexa
+    # con (y & 7, x & 7), sin mapa HxW ni temporales. Mismo redondeo que la
+    # expresión NumPy: b*0.85 en float32 y el desplazamiento en float64.
+    h, w = lin.shape
+    out = np.empty((h, w), dtype=np.bool_)
+    k = np.float32(0.85)
+    for y in range(h):
+        row = _BAYER_8[y & 7]
+        for x in range(w):
+            out[y, x] = lin[y, x] > (np.float64(row[x & 7] * k) + off) + 0.5
+    return out
+
+def _bayer_white(lin: np.ndarray, threshold_0_255: int) -> np.ndarray:
+    """Bool mask (True=white) of the Bayer ordered dither."""
+    t = np.clip(threshold_0_255 / 255.0, 0.0, 1.0)
+    # Compare with shifted threshold: effectively controls overall density
+    return _bayer_kernel(np.ascontiguousarray(lin, dtype=np.float32), float(t - 0.5))
+
+def _white_to_u8(white: np.ndarray) -> np.ndarray:
+    # bool -> {0,255} sin pasar por un uint8 intermedio: vista + un solo producto
+    return white.view(np.uint8) * np.uint8(255)
+
 def dither_bayer(lin: np.ndarray, threshold_0_255: int) -> np.ndarray:
     """
     lin: [H,W] linear luma [0,1]
     threshold acts like global offset: 0..255 maps to 0..1.
     """
-    h, w = lin.shape
-    t = np.clip(threshold_0_255 / 255.0, 0.0, 1.0)
-    # Tile Bayer matrix
-    b = np.tile(_BAYER_8, (h // 8 + 1, w // 8 + 1))[:h, :w]
-    # Compare with shifted threshold: effectively controls overall density
-    out = (lin > (b * 0.85 + (t - 0.5) + 0.5)).astype(np.uint8) * 255
-    return out
+    return _white_to_u8(_bayer_white(lin, threshold_0_255))
 
 # ---------- Error diffusion kernels ----------
 
-def dither_floyd_steinberg(lin: np.ndarray, threshold_0_255: int, serpentine: bool = True) -> np.ndarray:
-    """
-    Floyd–Steinberg on linear luma.
-    """
-    t = np.clip(threshold_0_255 / 255.0, 0.0, 1.0)
-    a = lin.astype(np.float32).copy()
-    h, w = a.shape
-    out = np.zeros((h, w), dtype=np.uint8)
+# Los kernels no modifican `lin`: trabajan sobre buffers de fila (la fila
+# actual y las siguientes que reciben error) que se rotan al bajar, de modo
+# que el working set son 2-3 filas en L1 en vez de toda la imagen.
+# Cada buffer se carga con la fila de `lin` antes de recibir error, así el
+# orden de las sumas es el mismo que acumulando sobre una copia 2-D.
+# Son deliberadamente secuenciales: a 480x700 un barrido JIT cuesta unos pocos ms,
+# y un frente de onda diagonal paralelo (incompatible además con el barrido
+# serpentina) pagaría más en sincronización por paso que lo que ahorra.
+# Se quedan en float32: los buffers de fila (2-3 x w) viven en L1, así que pasar
+# a int16 no ahorra ancho de banda, y el píxel más el error recibido puede
+# superar 32767 (desbordaría sin saturar) además de cambiar el resultado.
+
+@njit("void(f4[:, ::1], u1[:, ::1], f4, b1)", cache=True, boundscheck=False, fastmath=True)
+def _fs_kernel(lin, out, t, serpentine):
+    h, w = lin.shape
+    w_r = np.float32(7 / 16)
+    w_bl = np.float32(3 / 16)
+    w_b = np.float32(5 / 16)
+    w_br = np.float32(1 / 16)
+
+    cur = np.empty(w, dtype=np.float32)
+    nxt = lin[0].copy()
 
     for y in range(h):
+        cur, nxt = nxt, cur
+        if y + 1 < h:
+            nxt[:] = lin[y + 1]
+
         if serpentine and (y % 2 == 1):
-            xs = range(w-1, -1, -1)
+            x = w - 1
             dir = -1
         else:
-            xs = range(w)
+            x = 0
             dir = 1
 
-        for x in xs:
-            old = a[y, x]
-            new = 1.0 if old >= t else 0.0
+        for _ in range(w):
+            old = cur[x]
+            new = np.float32(1.0) if old >= t else np.float32(0.0)
             out[y, x] = 255 if new > 0 else 0
             err = old - new
 
-            # Distribute error
-            x1 = x + dir
-            if 0 <= x1 < w:
-                a[y, x1] += err * (7/16)
-
-            y1 = y + 1
-            if y1 < h:
-                # below-left, below, below-right depend on direction
-                if dir == 1:
-                    if x - 1 >= 0:
-                        a[y1, x-1] += err * (3/16)
-                    a[y1, x] += err * (5/16)
-                    if x + 1 < w:
-                        a[y1, x+1] += err * (1/16)
-                else:
-                    if x + 1 < w:
-                        a[y1, x+1] += err * (3/16)
-                    a[y1, x] += err * (5/16)
-                    if x - 1 >= 0:
-                        a[y1, x-1] += err * (1/16)
+            # Distribute error. Offsets relative to scan direction (xf = ahead,
+            # xb = behind) so the mirrored kernel needs no per-pixel branch:
+            #        x   7
+            #    3   5   1
+            xf = x + dir
+            xb = x - dir
+            if 0 <= xf < w:
+                cur[xf] += err * w_r
+
+            if y + 1 < h:
+                if 0 <= xb < w:
+                    nxt[xb] += err * w_bl
+                nxt[x] += err * w_b
+                if 0 <= xf < w:
+                    nxt[xf] += err * w_br
+            x += dir
 
-    return out
-
-def dither_atkinson(lin: np.ndarray, threshold_0_255: int, serpentine: bool = True) -> np.ndarray:
+def dither_floyd_steinberg(lin: np.ndarray, threshold_0_255: int, serpentine: bool = True) -> np.ndarray:
     """
-    Atkinson diffusion on linear luma.
-    Kernel (normalized by 1/8):
-      x  1  1
-      1  1  1
-         1
+    Floyd–Steinberg on linear luma.
     """
     t = np.clip(threshold_0_255 / 255.0, 0.0, 1.0)
-    a = lin.astype(np.float32).copy()
-    h, w = a.shape
-    out = np.zeros((h, w), dtype=np.uint8)
+    a = np.ascontiguousarray(lin, dtype=np.float32)
+    out = np.zeros(a.shape, dtype=np.uint8)
+    _fs_kernel(a, out, np.float32(t), serpentine)
+    return out
+
+@njit("void(f4[:, ::1], u1[:, ::1], f4, b1)", cache=True, boundscheck=False, fastmath=True)
+def _atkinson_kernel(lin, out, t, serpentine):
+    h, w = lin.shape
+    cur = np.empty(w, dtype=np.float32)
+    n1 = lin[0].copy()
+    n2 = lin[1].copy() if h > 1 else np.empty(w, dtype=np.float32)
 
     for y in range(h):
+        cur, n1, n2 = n1, n2, cur
+        if y + 2 < h:
+            n2[:] = lin[y + 2]
+
         if serpentine and (y % 2 == 1):
-            xs = range(w-1, -1, -1)
+            x = w - 1
             dir = -1
         else:
-            xs = range(w)
+            x = 0
             dir = 1
 
-        for x in xs:
-            old = a[y, x]
-            new = 1.0 if old >= t else 0.0
+        for _ in range(w):
+            old = cur[x]
+            new = np.float32(1.0) if old >= t else np.float32(0.0)
             out[y, x] = 255 if new > 0 else 0
-            err = (old - new) / 8.0
+            err = (old - new) / np.float32(8.0)
 
             # positions relative to scan direction
-            def add(xx, yy):
-                if 0 <= xx < w and 0 <= yy < h:
-                    a[yy, xx] += err
-
-            add(x + dir, y)
-            add(x + 2*dir, y)
-            add(x - dir, y + 1)
-            add(x,       y + 1)
-            add(x + dir, y + 1)
-            add(x,       y + 2)
+            xf1 = x + dir
+            xf2 = x + 2*dir
+            xb1 = x - dir
+            if 0 <= xf1 < w:
+                cur[xf1] += err
+            if 0 <= xf2 < w:
+                cur[xf2] += err
+            if y + 1 < h:
+                if 0 <= xb1 < w:
+                    n1[xb1] += err
+                n1[x] += err
+                if 0 <= xf1 < w:
+                    n1[xf1] += err
+            if y + 2 < h:
+                n2[x] += err
+            x += dir
 
+def dither_atkinson(lin: np.ndarray, threshold_0_255: int, serpentine: bool = True) -> np.ndarray:
+    """
+    Atkinson diffusion on linear luma.
+    Kernel (normalized by 1/8):
+      x  1  1
+      1  1  1
+         1
+    """
+    t = np.clip(threshold_0_255 / 255.0, 0.0, 1.0)
+    a = np.ascontiguousarray(lin, dtype=np.float32)
+    out = np.zeros(a.shape, dtype=np.uint8)
+    _atkinson_kernel(a, out, np.float32(t), serpentine)
     return out
 
 # ---------- Main API ----------
@@ -233,20 +298,34 @@ def dither_image_pil(
 
     # Convert input to linear luma [0,1]
     if img_pil.mode in ("RGB", "RGBA"):
-        rgb = np.array(img_pil.convert("RGB"), dtype=np.uint8)
+        rgb_img = img_pil.convert("RGB")
+        rgb = np.frombuffer(rgb_img.tobytes(), dtype=np.uint8).reshape(
+            rgb_img.size[1], rgb_img.size[0], 3)
         lin = rgb_to_luma_linear(rgb)
+        if contrast != 1.0:
+            # El clip va después de mezclar canales, así que aquí no se puede
+            # hornear en la LUT: se aplica en sitio sobre la luma
+            np.subtract(lin, np.float32(0.5), out=lin)
+            np.multiply(lin, np.float32(contrast), out=lin)
+            np.add(lin, np.float32(0.5), out=lin)
+            np.clip(lin, 0.0, 1.0, out=lin)
     else:
-        # Treat as grayscale in sRGB; convert to linear
-        g = np.array(img_pil.convert("L"), dtype=np.uint8).astype(np.float32) / 255.0
-        lin = srgb_to_linear(g)
-
-    lin = apply_contrast_curve(lin, contrast=contrast, mid=0.5)
-
-    if method == "none":
-        t = threshold / 255.0
-        out = (lin >= t).astype(np.uint8) * 255
-    elif method == "bayer":
-        out = dither_bayer(lin, threshold)
+        # Treat as grayscale in sRGB; convert to linear (contraste en la LUT)
+        g = np.asarray(img_pil.convert("L"), dtype=np.uint8)
+        lut = _SRGB2LIN_LUT if contrast == 1.0 else _srgb2lin_contrast_lut(float(contrast))
+        lin = lut[g]
+
+    if method in ("none", "bayer"):
+        if method == "none":
+            white = lin >= threshold / 255.0
+        else:
+            white = _bayer_white(lin, threshold)
+        if out_mode_1bit:
+            # Umbral puro: empaquetar directamente a 1 bit (PIL "1": MSB first,
+            # filas rellenas a byte, 1 = blanco) sin pasar por "L"
+            h, w = white.shape
+            return Image.frombytes("1", (w, h), np.packbits(white, axis=1).tobytes())
+        out = _white_to_u8(white)
     elif method == "atkinson":
         out = dither_atkinson(lin, threshold, serpentine=serpentine)
     elif method in ("floyd", "floydsteinberg", "fs"):
@@ -1,23 +1,26 @@
 from __future__ import annotations
 import json
 import os
+import hashlib
 import logging
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from typing import Optional
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, status
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer
 
 from .models import CardData
 from .storage import JsonStore
-from .openai_client import suggest_card
-from .renderer import render_card
 from .utils import ensure_dir, safe_filename, slugify
 from .auth import authenticate_user, create_access_token, verify_token
 from .logging_config import setup_logging
+import orjson
 import requests
 from io import BytesIO
 
@@ -147,23 +150,9 @@ def get_me(username: str = Depends(get_current_user)):
 
 @app.get("/api/cards")
 def list_cards(q: Optional[str] = None, piece_type: Optional[str] = None, skip: int = 0, limit: int = 25):
-    cards, total = store.list_cards(q=q, piece_type=piece_type, skip=skip, limit=limit)
-    # respuesta ligera con total
-    return {
-        "cards": [{
-            "id": c.id,
-            "created_at": c.created_at,
-            "updated_at": c.updated_at,
-            "piece_number": c.data.piece_number,
-            "cabinet_number": c.data.cabinet_number,
-            "piece_type": c.data.piece_type,
-            "title": c.data.title,
-            "subtitle": c.data.subtitle,
-            "render_path": c.data.render_path,
-            "image_path": c.data.image_path,
-        } for c in cards],
-        "total": total
-    }
+    # respuesta ligera con total, desde la proyección cacheada del store
+    cards, total = store.list_light(q=q, piece_type=piece_type, skip=skip, limit=limit)
+    return Response(content=orjson.dumps({"cards": cards, "total": total}), media_type="application/json")
 
 @app.get("/api/cards/{card_id}")
 def get_card(card_id: str):
@@ -237,7 +226,27 @@ def duplicate_card(card_id: str, username: str = Depends(get_current_user)):
     return rec.model_dump()
 
 @app.post("/api/suggest")
-def api_suggest(payload: dict, username: str = Depends(get_current_user)):
+async def api_suggest(payload: dict, username: str = Depends(get_current_user)):
+    name_query = (payload.get("name_query") or "").strip()
+    piece_type = (payload.get("piece_type") or "other").strip()
+    piece_number = (payload.get("piece_number") or "").strip()
+
+    if not name_query:
+        raise HTTPException(400, "name_query is required")
+
+    # Import diferido (openai + requests): solo se carga al primer uso
+    from .openai_client import suggest_card_json_async
+    try:
+        # JSON del modelo tal cual: sin parsear a dict y volver a serializar
+        suggestion = await suggest_card_json_async(name_query=name_query, piece_type=piece_type, piece_number=piece_number)
+    except Exception as e:
+        raise HTTPException(500, f"Suggest failed: {e}")
+
+    return Response(content=suggestion, media_type="application/json")
+
+@app.post("/api/suggest/stream")
+async def api_suggest_stream(payload: dict, username: str = Depends(get_current_user)):
+    """Como /api/suggest, pero envía el JSON según lo genera el modelo (menor tiempo al primer byte)"""
     name_query = (payload.get("name_query") or "").strip()
     piece_type = (payload.get("piece_type") or "other").strip()
     piece_number = (payload.get("piece_number") or "").strip()
@@ -245,12 +254,144 @@ def api_suggest(payload: dict, username: str = Depends(get_current_user)):
     if not name_query:
         raise HTTPException(400, "name_query is required")
 
+    from .openai_client import suggest_card_stream_async
+    parts = suggest_card_stream_async(name_query=name_query, piece_type=piece_type, piece_number=piece_number)
+    # El primer trozo se espera aquí: los errores de configuración/red aún pueden ser un 500
     try:
-        suggestion = suggest_card(name_query=name_query, piece_type=piece_type, piece_number=piece_number)
+        first = await parts.__anext__()
+    except StopAsyncIteration:
+        first = ""
     except Exception as e:
         raise HTTPException(500, f"Suggest failed: {e}")
 
-    return suggestion
+    async def body():
+        yield first
+        async for part in parts:
+            yield part
+
+    return StreamingResponse(body(), media_type="application/json")
+
+# Cache LRU de previews ya codificados (PNG) por hash de (data, mtime imagen, dither).
+# El editor pide un preview en cada cambio; repetir el mismo estado no re-renderiza.
+PREVIEW_CACHE_SIZE = 64
+_preview_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_preview_cache_lock = threading.Lock()
+
+# Segundo nivel en disco, direccionado por contenido (misma clave): sobrevive a
+# reinicios y se comparte entre workers. Acotado por tamaño total: cada
+# PREVIEW_DISK_SWEEP_EVERY escrituras (y en la primera) se borran los más antiguos.
+# El directorio se crea al escribir por primera vez, no al importar el módulo
+PREVIEW_CACHE_DIR = Path("/tmp/cartelas_previews")
+PREVIEW_DISK_MAX_BYTES = 64 * 1024 * 1024
+PREVIEW_DISK_SWEEP_EVERY = 50
+_preview_disk_writes = 0
+
+# Versión del render en la clave: subirla con cualquier cambio visible de la
+# cartela. Además se mezcla el contenido del código y fuentes del renderer, así
+# que un despliegue que los cambie no sirve PNGs viejos aunque se olvide subirla
+PREVIEW_RENDER_VERSION = 1
+
+def _render_fingerprint() -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(PREVIEW_RENDER_VERSION).encode())
+    app_dir = Path(__file__).resolve().parent
+    for p in ("renderer.py", "dither2.py", "assets/Roboto-Regular.ttf", "assets/Roboto-Bold.ttf"):
+        try:
+            h.update((app_dir / p).read_bytes())
+        except OSError:
+            h.update(b"-")
+    return h.digest()
+
+_RENDER_FINGERPRINT = _render_fingerprint()
+
+def _preview_key(data_obj: dict, image_path: Optional[str], dither) -> str:
+    mtime = ""
+    if image_path and not image_path.startswith(("http://", "https://")):
+        try:
+            st = os.stat(image_path)
+            mtime = f"{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            pass
+    h = hashlib.blake2b(digest_size=16)
+    h.update(_RENDER_FINGERPRINT)
+    h.update(json.dumps(data_obj, sort_keys=True, ensure_ascii=False).encode())
+    h.update(b"\0" + mtime.encode() + b"\0" + str(dither).encode())
+    return h.hexdigest()
+
+def _clear_preview_cache() -> None:
+    # Solo la LRU en memoria: las entradas en disco llevan mtime/tamaño de la imagen
+    # en la clave, así que una imagen reemplazada nunca reutiliza un preview viejo
+    with _preview_cache_lock:
+        _preview_cache.clear()
+
+def _remember_preview(key: str, png: bytes) -> None:
+    with _preview_cache_lock:
+        _preview_cache[key] = png
+        _preview_cache.move_to_end(key)
+        if len(_preview_cache) > PREVIEW_CACHE_SIZE:
+            _preview_cache.popitem(last=False)
+
+def _read_preview_disk(key: str) -> Optional[bytes]:
+    path = PREVIEW_CACHE_DIR / f"{key}.png"
+    try:
+        png = path.read_bytes()
+        os.utime(path)  # el barrido borra por antigüedad de uso, no de creación
+        return png
+    except OSError:
+        return None
+
+def _sweep_preview_disk() -> None:
+    """Borra los previews más antiguos hasta quedar bajo PREVIEW_DISK_MAX_BYTES"""
+    entries = []
+    now = time.time()
+    try:
+        paths = list(PREVIEW_CACHE_DIR.iterdir())
+    except OSError:
+        return
+    for p in paths:
+        try:
+            st = p.stat()
+            # temporales huérfanos de escrituras interrumpidas
+            if p.suffix == ".tmp":
+                if now - st.st_mtime > 3600:
+                    p.unlink()
+                continue
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(e[1] for e in entries)
+    entries.sort()
+    for _, size, p in entries:
+        if total <= PREVIEW_DISK_MAX_BYTES:
+            break
+        try:
+            p.unlink()
+        except OSError:
+            continue
+        total -= size
+
+def _write_preview_disk(key: str, png: bytes) -> None:
+    global _preview_disk_writes
+    # Escritura atómica: fichero temporal + rename
+    path = PREVIEW_CACHE_DIR / f"{key}.png"
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        try:
+            tmp.write_bytes(png)
+        except FileNotFoundError:
+            # Directorio aún no creado (o borrado por la limpieza de /tmp)
+            PREVIEW_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(png)
+        tmp.replace(path)
+    except OSError as e:
+        logger.warning(f"No se pudo guardar el preview en disco: {e}")
+        return
+    with _preview_cache_lock:
+        _preview_disk_writes += 1
+        # Primera escritura del proceso: barre lo que dejaron ejecuciones anteriores
+        sweep = _preview_disk_writes % PREVIEW_DISK_SWEEP_EVERY == 1
+    if sweep:
+        _sweep_preview_disk()
 
 @app.post("/api/preview")
 def api_preview(payload: dict, username: str = Depends(get_current_user)):
@@ -259,20 +400,41 @@ def api_preview(payload: dict, username: str = Depends(get_current_user)):
         data_obj = payload.get("data", {})
         dither = payload.get("dither", "none")  # nombre del algoritmo: none, ordered, floyd_steinberg, etc.
         image_path = data_obj.get("image_path")
+
+        key = _preview_key(data_obj, image_path, dither)
+        with _preview_cache_lock:
+            png = _preview_cache.get(key)
+            if png is not None:
+                _preview_cache.move_to_end(key)
+        if png is None:
+            png = _read_preview_disk(key)
+            if png is not None:
+                _remember_preview(key, png)
+        if png is not None:
+            return Response(content=png, media_type="image/png")
         
-        # Render
+        # Render (import diferido: PIL/numpy/numba solo al primer render)
+        from .renderer import render_card
         img, cached_path = render_card(data_obj, image_path=image_path, dither=dither)
         
         # Devolver como respuesta directa sin guardar
-        from io import BytesIO
         buf = BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
+        # Preview efímero: zlib nivel 1 (mucho más rápido, algo más grande);
+        # los renders persistidos mantienen la compresión por defecto
+        img.save(buf, format="PNG", compress_level=1, optimize=False)
+        png = buf.getvalue()
+        # Renders degradados (fuente por defecto, imagen con ERROR) no se cachean
+        # en ningún nivel: el siguiente preview reintenta la fuente/la imagen
+        if not img.info.get("degraded"):
+            _write_preview_disk(key, png)
+            _remember_preview(key, png)
         
-        return Response(content=buf.getvalue(), media_type="image/png")
+        return Response(content=png, media_type="image/png")
     except Exception as e:
         raise HTTPException(500, f"Preview failed: {e}")
 
+UPLOAD_CHUNK_SIZE = 1 << 16
+
 @app.post("/api/cards/{card_id}/upload-image")
 async def upload_image(card_id: str, image: UploadFile = File(...), username: str = Depends(get_current_user)):
     c = store.get(card_id)
@@ -289,9 +451,12 @@ async def upload_image(card_id: str, image: UploadFile = File(...), username: st
     fn = f"{slug}{ext}"
     out = IMAGES / fn
     
-    content = await image.read()
-    out.write_bytes(content)
+    # Volcado a disco por bloques de 64 KB: la subida nunca está entera en memoria
+    with out.open("wb") as f:
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
     logger.info(f"Image uploaded and cached: {out}")
+    _clear_preview_cache()
 
     c.data.image_path = str(out)
     c.data.render_path = None
@@ -319,6 +484,7 @@ async def api_render(
     image_path = data_obj.get("image_path")
 
     # Render
+    from .renderer import render_card
     img, cached_path = render_card(data_obj, image_path=image_path, dither=dither)
 
     out_png = RENDERS / f"{card_id}.png"
@@ -354,23 +520,21 @@ def render_tri(card_id: str, payload: dict, username: str = Depends(get_current_
         image_path = c.data.image_path
         
         # Renderizar imagen PNG
+        from .renderer import render_card, convert_to_tri
         img, cached_path = render_card(c.data.model_dump(), image_path=image_path, dither=dither)
         
-        # Actualizar image_path si se cacheó
+        # Actualizar image_path si se cacheó (se persiste junto con render_path)
         if cached_path and cached_path != c.data.image_path:
             c.data.image_path = cached_path
-            store.update(card_id, c.data)
         
         # Convertir a TRI
-        from .renderer import convert_to_tri
         tri_bytes = convert_to_tri(img)
         
         # Guardar render si es necesario
         out_png = RENDERS / f"{card_id}.png"
         img.save(str(out_png), "PNG")
-        new_data = CardData.model_validate(c.data.model_dump())
-        new_data.render_path = str(out_png)
-        store.update(card_id, new_data)
+        c.data.render_path = str(out_png)
+        store.update(card_id, c.data)
         
         return Response(content=tri_bytes, media_type="application/octet-stream", headers={
             "Content-Disposition": f"attachment; filename=\"{card_id}.tri\""
@@ -1,14 +1,21 @@
 from __future__ import annotations
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Literal, Optional
 
 PieceType = Literal["computer", "console", "peripheral", "software", "other"]
 
+# Esquemas de validación construidos al primer uso (no al importar); campos extra se ignoran
+_MODEL_CONFIG = ConfigDict(defer_build=True, validate_assignment=False, extra="ignore")
+
 class TechLine(BaseModel):
+    model_config = _MODEL_CONFIG
+
     label: str = Field(min_length=1, max_length=32)
     value: str = Field(min_length=1, max_length=96)
 
 class CardData(BaseModel):
+    model_config = _MODEL_CONFIG
+
     piece_number: str = Field(default="", max_length=48)
     piece_type: PieceType = "other"
     name_query: str = Field(default="", max_length=160)
@@ -31,6 +38,8 @@ class CardData(BaseModel):
     image_scale: float = Field(default=1.0, ge=0.1, le=3.0)  # Escala de imagen (0.1 a 3.0)
 
 class CardRecord(BaseModel):
+    model_config = _MODEL_CONFIG
+
     id: str
     created_at: str
     updated_at: str
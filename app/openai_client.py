@@ -1,11 +1,44 @@
 from __future__ import annotations
 import os
 import json
-from typing import Any, Dict, List
+import functools
+import time
+import hashlib
+import tempfile
+from typing import Any, AsyncIterator, Dict, List
 
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+WIKI_API = "https://en.wikipedia.org/w/api.php"
+_WIKI_HEADERS = {"User-Agent": "cartelas/0.1 (https://github.com/javipalanca/cartelas)"}
+
+# Sesión HTTP compartida: reutiliza conexiones TCP/TLS con Wikipedia entre llamadas
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+_HTTP.headers.update(_WIKI_HEADERS)
+
+# Cliente asíncrono compartido (se crea al primer uso, dentro del event loop)
+_AHTTP: httpx.AsyncClient | None = None
+
+def _async_http() -> httpx.AsyncClient:
+    global _AHTTP
+    if _AHTTP is None:
+        _AHTTP = httpx.AsyncClient(headers=_WIKI_HEADERS, timeout=10)
+    return _AHTTP
+
+# Cache en disco de contextos de Wikipedia (consulta normalizada -> extracto)
+WIKI_CACHE_DIR = "/tmp/cartelas_wiki"
+WIKI_CACHE_TTL = 7 * 24 * 3600  # segundos
+os.makedirs(WIKI_CACHE_DIR, exist_ok=True)
+
+# Cache en disco de respuestas del LLM (modelo + tipo + consulta + contexto)
+LLM_CACHE_DIR = "/tmp/cartelas_llm"
+LLM_CACHE_TTL = 30 * 24 * 3600  # segundos
+os.makedirs(LLM_CACHE_DIR, exist_ok=True)
 
 PIECE_TYPE_GUIDE: Dict[str, List[str]] = {
     "computer": ["CPU", "RAM", "Almacenamiento", "Gráficos", "Bus"],
@@ -15,138 +48,38 @@ PIECE_TYPE_GUIDE: Dict[str, List[str]] = {
     "other": ["Dato 1", "Dato 2", "Dato 3", "Dato 4"],
 }
 
-def _fetch_wikipedia_context(query: str) -> str:
-    """Busca contexto en Wikipedia (EN) y devuelve un extracto útil."""
-    if not query:
-        return ""
-
-    session = requests.Session()
-    session.headers.update({
-        "User-Agent": "cartelas/0.1 (https://github.com/javipalanca/cartelas)"
-    })
-
-    try:
-        search_resp = session.get(
-            "https://en.wikipedia.org/w/api.php",
-            params={
-                "action": "query",
-                "list": "search",
-                "srsearch": query,
-                "srlimit": 5,
-                "srenablerewrites": 1,
-                "srprop": "",
-                "format": "json",
+_CARTELA_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "piece_number": {"type": "string"},
+        "piece_type": {"type": "string"},
+        "name_query": {"type": "string"},
+        "title": {"type": "string"},
+        "year": {"type": "string"},
+        "subtitle": {"type": "string"},
+        "bullets": {"type": "array", "items": {"type": "string"}, "minItems": 3, "maxItems": 6},
+        "tech": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"label": {"type": "string"}, "value": {"type": "string"}},
+                "required": ["label", "value"]
             },
-            timeout=10,
-        )
-        search_resp.raise_for_status()
-        data = search_resp.json()
-        results = data.get("query", {}).get("search", [])
-        if not results:
-            return ""
-
-        for result in results:
-            title = result.get("title")
-            if not title:
-                continue
-
-            # Obtener artículo completo con más contenido
-            article_resp = session.get(
-                "https://en.wikipedia.org/w/api.php",
-                params={
-                    "action": "query",
-                    "titles": title,
-                    "prop": "extracts",
-                    "explaintext": 1,
-                    "exsectionformat": "plain",
-                    "format": "json",
-                },
-                timeout=10,
-            )
-            if not article_resp.ok:
-                continue
-
-            article_data = article_resp.json()
-            pages = article_data.get("query", {}).get("pages", {})
-            if not pages:
-                continue
-
-            page = next(iter(pages.values()), {})
-            if "missing" in page:
-                continue
-
-            extract = page.get("extract", "")
-            if not extract:
-                continue
-
-            # Limitar 5000 caracteres aprox (2-3 párrafos)
-            max_len = 5000
-            if len(extract) > max_len:
-                # Cortar en el último punto dentro del límite
-                truncated = extract[:max_len]
-                last_period = truncated.rfind(".")
-                if last_period > max_len * 0.7:  # Si el punto está en los últimos 30%
-                    extract = truncated[:last_period + 1]
-                else:
-                    extract = truncated.rstrip() + "..."
-            
-            # Remover líneas que parecen referencias o markup
-            lines = extract.split("\n")
-            cleaned_lines = [l for l in lines if l.strip() and not l.startswith("==")]
-            extract = "\n".join(cleaned_lines)
-
-            return f"{title}\n{extract}"
-
-        return ""
-    except Exception:
-        return ""
-
-def suggest_card(name_query: str, piece_type: str, piece_number: str = "") -> Dict[str, Any]:
-    api_key = os.environ.get("OPENAI_API_KEY", "")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY no está configurada")
-
-    model = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
-    base_url = os.environ.get("BASE_URL", None)
-    
-    # Si hay BASE_URL, úsala; de lo contrario, usa el servidor por defecto de OpenAI
-    if base_url:
-        client = OpenAI(api_key=api_key, base_url=base_url)
-    else:
-        client = OpenAI(api_key=api_key)
-
-    tech_labels = PIECE_TYPE_GUIDE.get(piece_type, PIECE_TYPE_GUIDE["other"])
-
-    schema = {
-        "type": "object",
-        "properties": {
-            "piece_number": {"type": "string"},
-            "piece_type": {"type": "string"},
-            "name_query": {"type": "string"},
-            "title": {"type": "string"},
-            "year": {"type": "string"},
-            "subtitle": {"type": "string"},
-            "bullets": {"type": "array", "items": {"type": "string"}, "minItems": 3, "maxItems": 6},
-            "tech": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {"label": {"type": "string"}, "value": {"type": "string"}},
-                    "required": ["label", "value"]
-                },
-                "minItems": 3,
-                "maxItems": 6
-            },
-            "notes": {"type": "string"}
+            "minItems": 3,
+            "maxItems": 6
         },
-        "required": ["piece_number", "piece_type", "name_query", "title", "year", "subtitle", "bullets", "tech"]
-    }
+        "notes": {"type": "string"}
+    },
+    "required": ["piece_number", "piece_type", "name_query", "title", "year", "subtitle", "bullets", "tech"]
+}
 
-    wiki_context = _fetch_wikipedia_context(name_query)
-    wiki_block = f"\nContexto (Wikipedia EN):\n{wiki_context}\n" if wiki_context else "\nContexto (Wikipedia EN): (no encontrado)\n"
-    print("Bloque de contexto Wikipedia:", wiki_block)
+_RESPONSE_FORMAT: Dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {"name": "cartela", "schema": _CARTELA_SCHEMA}
+}
 
-    prompt = f"""
+# Plantilla del prompt (str.format): {name_query}, {piece_type}, {wiki_block}, {tech_labels}
+_PROMPT_TEMPLATE = """
 Eres curador técnico de un museo de informática. Tu tarea es generar una cartela divulgativa **completa, detallada y confiable** para la siguiente pieza.
 
 PIEZA A DOCUMENTAR:
@@ -221,12 +154,251 @@ EJEMPLO DE RESPUESTA VÁLIDA:
 Procede a generar la cartela COMPLETA y DETALLADA.
 """
 
-    resp = client.chat.completions.create(
+def _read_cache(path: str, ttl: float) -> str | None:
+    """Devuelve el texto cacheado si existe y no ha caducado, o None"""
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write_cache(path: str, text: str) -> None:
+    """Escritura atómica: fichero temporal en el mismo directorio + rename"""
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+def _read_json_cache(path: str, ttl: float) -> Any:
+    raw = _read_cache(path, ttl)
+    try:
+        return None if raw is None else json.loads(raw)
+    except ValueError:
+        return None
+
+def _write_json_cache(path: str, obj: Any) -> None:
+    _write_cache(path, json.dumps(obj, ensure_ascii=False))
+
+def _wiki_params(query: str) -> Dict[str, Any]:
+    # Búsqueda + extracto en una sola petición (generator=search): un solo RTT.
+    # Los extractos completos solo se devuelven para una página, la primera.
+    return {
+        "action": "query",
+        "generator": "search",
+        "gsrsearch": query,
+        "gsrlimit": 1,
+        "gsrenablerewrites": 1,
+        "prop": "extracts",
+        "explaintext": 1,
+        "exsectionformat": "plain",
+        "format": "json",
+    }
+
+def _parse_wiki_pages(data: Dict[str, Any]) -> str:
+    """Extrae título + extracto limpio de la respuesta de la API (o cadena vacía)"""
+    pages = data.get("query", {}).get("pages", {})
+    if not pages:
+        return ""
+
+    for page in pages.values():
+        title = page.get("title")
+        if not title or "missing" in page:
+            continue
+
+        extract = page.get("extract", "")
+        if not extract:
+            continue
+
+        # Limitar 5000 caracteres aprox (2-3 párrafos)
+        max_len = 5000
+        if len(extract) > max_len:
+            # Cortar en el último punto dentro del límite
+            truncated = extract[:max_len]
+            last_period = truncated.rfind(".")
+            if last_period > max_len * 0.7:  # Si el punto está en los últimos 30%
+                extract = truncated[:last_period + 1]
+            else:
+                extract = truncated.rstrip() + "..."
+        
+        # Remover líneas que parecen referencias o markup (sobre el texto ya
+        # recortado: como mucho ~5000 caracteres, no el artículo entero).
+        # Lista y no generador: str.join la materializa igualmente y así es más rápido
+        lines = extract.split("\n")
+        cleaned_lines = [l for l in lines if l.strip() and not l.startswith("==")]
+        extract = "\n".join(cleaned_lines)
+
+        return f"{title}\n{extract}"
+
+    return ""
+
+def _wiki_cache_path(query: str) -> str:
+    key = hashlib.md5(query.lower().strip().encode()).hexdigest()
+    return os.path.join(WIKI_CACHE_DIR, f"{key}.json")
+
+def _query_wikipedia(query: str) -> str:
+    try:
+        resp = _HTTP.get(WIKI_API, params=_wiki_params(query), timeout=10)
+        resp.raise_for_status()
+        return _parse_wiki_pages(resp.json())
+    except Exception:
+        return ""
+
+async def _query_wikipedia_async(query: str) -> str:
+    try:
+        resp = await _async_http().get(WIKI_API, params=_wiki_params(query))
+        resp.raise_for_status()
+        return _parse_wiki_pages(resp.json())
+    except Exception:
+        return ""
+
+def _fetch_wikipedia_context(query: str) -> str:
+    """Busca contexto en Wikipedia (EN) y devuelve un extracto útil (cacheado en disco)."""
+    if not query:
+        return ""
+
+    cache_path = _wiki_cache_path(query)
+    cached = _read_json_cache(cache_path, WIKI_CACHE_TTL)
+    if cached is not None:
+        return cached.get("context", "")
+
+    context = _query_wikipedia(query)
+    # Solo se cachean aciertos: "" puede ser un fallo de red pasajero
+    if context:
+        _write_json_cache(cache_path, {"query": query, "context": context})
+    return context
+
+async def _fetch_wikipedia_context_async(query: str) -> str:
+    """Como _fetch_wikipedia_context, sin bloquear el event loop en la red."""
+    if not query:
+        return ""
+
+    cache_path = _wiki_cache_path(query)
+    cached = _read_json_cache(cache_path, WIKI_CACHE_TTL)
+    if cached is not None:
+        return cached.get("context", "")
+
+    context = await _query_wikipedia_async(query)
+    if context:
+        _write_json_cache(cache_path, {"query": query, "context": context})
+    return context
+
+def _openai_settings() -> tuple:
+    """(api_key, model, base_url) desde el entorno"""
+    api_key = os.environ.get("OPENAI_API_KEY", "")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY no está configurada")
+
+    model = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+    base_url = os.environ.get("BASE_URL", None)
+    return api_key, model, base_url
+
+# Clientes OpenAI compartidos entre llamadas (pool keep-alive + HTTP/2)
+_OPENAI_LIMITS = httpx.Limits(max_keepalive_connections=20)
+
+@functools.lru_cache(maxsize=4)
+def _openai_client(api_key: str, base_url: str | None) -> OpenAI:
+    # Si hay BASE_URL, úsala; de lo contrario, usa el servidor por defecto de OpenAI
+    http_client = httpx.Client(http2=True, limits=_OPENAI_LIMITS)
+    if base_url:
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    return OpenAI(api_key=api_key, http_client=http_client)
+
+@functools.lru_cache(maxsize=4)
+def _async_openai_client(api_key: str, base_url: str | None) -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(http2=True, limits=_OPENAI_LIMITS)
+    if base_url:
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+def _prepare_suggestion(name_query: str, piece_type: str, wiki_context: str, model: str, base_url: str | None) -> tuple:
+    """Construye la petición al LLM y su ruta de cache: (cache_path, kwargs de create)"""
+    tech_labels = PIECE_TYPE_GUIDE.get(piece_type, PIECE_TYPE_GUIDE["other"])
+
+    wiki_block = f"\nContexto (Wikipedia EN):\n{wiki_context}\n" if wiki_context else "\nContexto (Wikipedia EN): (no encontrado)\n"
+    print("Bloque de contexto Wikipedia:", wiki_block)
+
+    prompt = _PROMPT_TEMPLATE.format(
+        name_query=name_query, piece_type=piece_type, wiki_block=wiki_block, tech_labels=tech_labels,
+    )
+
+    # El prompt es determinista en estos campos: si ya se generó, no repetir la llamada
+    key = hashlib.sha1(f"{base_url}|{model}|{piece_type}|{name_query.lower().strip()}|{wiki_block}".encode()).hexdigest()
+    cache_path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+    request = dict(
         model=model,
         messages=[{"role": "user", "content": prompt}],
-        response_format={
-            "type": "json_schema",
-            "json_schema": {"name": "cartela", "schema": schema}
-        },
+        response_format=_RESPONSE_FORMAT,
     )
-    return json.loads(resp.choices[0].message.content)
\ No newline at end of file
+    return cache_path, request
+
+def suggest_card_json(name_query: str, piece_type: str, piece_number: str = "", use_wiki: bool = True) -> str:
+    """Sugerencia como texto JSON tal cual lo devuelve el modelo (o la cache)."""
+    api_key, model, base_url = _openai_settings()
+    wiki_context = _fetch_wikipedia_context(name_query) if use_wiki else ""
+    cache_path, request = _prepare_suggestion(name_query, piece_type, wiki_context, model, base_url)
+
+    cached = _read_cache(cache_path, LLM_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    client = _openai_client(api_key, base_url)
+    resp = client.chat.completions.create(**request)
+    raw = resp.choices[0].message.content
+    json.loads(raw)  # solo se cachea JSON válido
+    _write_cache(cache_path, raw)
+    return raw
+
+def suggest_card(name_query: str, piece_type: str, piece_number: str = "", use_wiki: bool = True) -> Dict[str, Any]:
+    return json.loads(suggest_card_json(name_query, piece_type, piece_number, use_wiki))
+
+async def suggest_card_json_async(name_query: str, piece_type: str, piece_number: str = "", use_wiki: bool = True) -> str:
+    """Versión asíncrona de suggest_card_json (para el endpoint); misma cache y prompt."""
+    api_key, model, base_url = _openai_settings()
+    wiki_context = await _fetch_wikipedia_context_async(name_query) if use_wiki else ""
+    cache_path, request = _prepare_suggestion(name_query, piece_type, wiki_context, model, base_url)
+
+    cached = _read_cache(cache_path, LLM_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    client = _async_openai_client(api_key, base_url)
+    resp = await client.chat.completions.create(**request)
+    raw = resp.choices[0].message.content
+    json.loads(raw)  # solo se cachea JSON válido
+    _write_cache(cache_path, raw)
+    return raw
+
+async def suggest_card_async(name_query: str, piece_type: str, piece_number: str = "", use_wiki: bool = True) -> Dict[str, Any]:
+    return json.loads(await suggest_card_json_async(name_query, piece_type, piece_number, use_wiki))
+
+async def suggest_card_stream_async(name_query: str, piece_type: str, piece_number: str = "", use_wiki: bool = True) -> AsyncIterator[str]:
+    """Como suggest_card_json_async, pero entrega el JSON por trozos según lo genera el modelo."""
+    api_key, model, base_url = _openai_settings()
+    wiki_context = await _fetch_wikipedia_context_async(name_query) if use_wiki else ""
+    cache_path, request = _prepare_suggestion(name_query, piece_type, wiki_context, model, base_url)
+
+    cached = _read_cache(cache_path, LLM_CACHE_TTL)
+    if cached is not None:
+        yield cached
+        return
+
+    client = _async_openai_client(api_key, base_url)
+    stream = await client.chat.completions.create(**request, stream=True)
+    parts: List[str] = []
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    raw = "".join(parts)
+    json.loads(raw)  # solo se cachea JSON válido
+    _write_cache(cache_path, raw)
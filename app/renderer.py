@@ -2,29 +2,73 @@ from __future__ import annotations
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 from typing import Tuple, List, Dict, Optional
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.request
 import tempfile
 import hashlib
 import struct
+import time
 import numpy as np
 from pathlib import Path
 from .dither2 import ditherea
 
+# Sesión HTTP compartida para fuentes e imágenes (conexiones reutilizadas)
+_HTTP = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=2, status_forcelist=[429, 500, 502, 503, 504]),
+)
+_HTTP.mount("https://", _HTTP_ADAPTER)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+
+def _download_to(url: str, dest: str | Path, timeout: int = 10) -> None:
+    """Descarga en streaming (bloques de 64 KiB) a un .part y lo renombra a dest"""
+    part = f"{dest}.part"
+    try:
+        with _HTTP.get(url, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            with open(part, "wb", buffering=1 << 16) as f:
+                for chunk in r.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+        os.replace(part, dest)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+# Fuentes Roboto versionadas en app/assets (Apache 2.0); si faltan, se descargan
+FONT_ASSETS_DIR = Path(__file__).resolve().parent / "assets"
+
 # Cache de fuentes en /tmp
 FONT_CACHE_DIR = "/tmp/cartelas_fonts"
 os.makedirs(FONT_CACHE_DIR, exist_ok=True)
 
+# Descargas de fuentes fallidas recientes (url -> instante del fallo): sin red, no
+# repetir el timeout en cada una de las 7 fuentes de cada render
+FONT_RETRY_SECONDS = 300
+_FONT_FAILED: Dict[str, float] = {}
+
 # Cache de imágenes descargadas
 BASE = Path(__file__).resolve().parent.parent
 IMAGE_CACHE_DIR = BASE / "data" / "images"
 IMAGE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
+def _url_hash(url: str) -> str:
+    # Hash no criptográfico para nombres de fichero (blake2b, como en main/auth)
+    return hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+
+def _legacy_url_hash(url: str) -> str:
+    # Nombre usado por caches antiguas; solo para encontrar ficheros ya descargados
+    return hashlib.md5(url.encode()).hexdigest()
+
 def _get_cached_font(url: str, size: int, bold: bool) -> ImageFont.FreeTypeFont:
     """Descarga y cachea fuentes desde GitHub"""
     # Crear nombre único basado en URL
-    font_hash = hashlib.md5(url.encode()).hexdigest()
+    font_hash = _url_hash(url)
     
     # Detectar extensión del archivo
     if url.endswith(".woff2"):
@@ -35,20 +79,25 @@ def _get_cached_font(url: str, size: int, bold: bool) -> ImageFont.FreeTypeFont:
         ext = ".ttf"
     
     cache_path = os.path.join(FONT_CACHE_DIR, f"{font_hash}{ext}")
+    legacy_path = os.path.join(FONT_CACHE_DIR, f"{_legacy_url_hash(url)}{ext}")
+    if not os.path.exists(cache_path) and os.path.exists(legacy_path):
+        cache_path = legacy_path
     
     # Si no está cacheado, descargar
     if not os.path.exists(cache_path):
+        if time.monotonic() - _FONT_FAILED.get(url, -FONT_RETRY_SECONDS) < FONT_RETRY_SECONDS:
+            return None
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            with open(cache_path, 'wb') as f:
-                f.write(response.content)
+            _download_to(url, cache_path)
             print(f"✓ Descargada fuente: {url}")
         except Exception as e:
             print(f"✗ Error descargando fuente: {e}")
+            _FONT_FAILED[url] = time.monotonic()
             return None
     
     try:
+        # Por ruta, no por objeto fichero: FreeType abre (y en Unix mapea) el
+        # fichero él mismo; con un file-like PIL lo leería entero a memoria
         return ImageFont.truetype(cache_path, size=size)
     except Exception as e:
         print(f"✗ Error cargando fuente {cache_path}: {e}")
@@ -61,19 +110,34 @@ TOP_BOX_SIZE = 50  # Cuadrado
 
 IMAGE_BOX_H = 230
 
+# Fuentes ya cargadas por (size, bold); solo se guardan las TrueType reales,
+# no el fallback, para reintentar la descarga si falló
+_FONTS: Dict[Tuple[int, bool], ImageFont.FreeTypeFont] = {}
+
 def _load_font(size: int, bold: bool = False) -> ImageFont.FreeTypeFont:
     """Carga fuentes de GitHub (openmaptiles/fonts - confiable en Docker)"""
+    font = _FONTS.get((size, bold))
+    if font:
+        return font
+
+    fname = "Roboto-Bold.ttf" if bold else "Roboto-Regular.ttf"
+
+    # Primero la copia local, sin red
+    try:
+        font = ImageFont.truetype(str(FONT_ASSETS_DIR / fname), size=size)
+        _FONTS[(size, bold)] = font
+        return font
+    except OSError:
+        pass
+
     # URLs raw de GitHub - totalmente confiables incluso en Docker
     base_url = "https://raw.githubusercontent.com/openmaptiles/fonts/master/roboto/"
-    
-    if bold:
-        url = base_url + "Roboto-Bold.ttf"
-    else:
-        url = base_url + "Roboto-Regular.ttf"
+    url = base_url + fname
     
     # Intentar cargar desde cache
     font = _get_cached_font(url, size, bold)
     if font:
+        _FONTS[(size, bold)] = font
         return font
     
     # Fallback: usar PIL default si falla la descarga
@@ -83,37 +147,67 @@ def _load_font(size: int, bold: bool = False) -> ImageFont.FreeTypeFont:
         return ImageFont.load_default()
 
 def _wrap(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.ImageFont, max_w: int) -> list[str]:
+    # Ancho acumulado por palabra: una medición por palabra en vez de re-medir la línea
     words = text.split()
+    if not words:
+        return []
+    # Caso habitual (bullets/valores cortos): cabe entero -> una sola medición
+    one = " ".join(words)
+    if draw.textlength(one, font=font) <= max_w:
+        return [one]
     lines: list[str] = []
+    space_w = draw.textlength(" ", font=font)
     cur = ""
+    cur_w = 0.0
     for w in words:
-        test = (cur + " " + w).strip()
-        if draw.textlength(test, font=font) <= max_w:
-            cur = test
+        word_w = draw.textlength(w, font=font)
+        test_w = cur_w + space_w + word_w if cur else word_w
+        if test_w <= max_w:
+            cur = f"{cur} {w}" if cur else w
+            cur_w = test_w
         else:
             if cur:
                 lines.append(cur)
             cur = w
+            cur_w = word_w
     if cur:
         lines.append(cur)
     return lines
 
-def _paste_into_box(base: Image.Image, img: Image.Image, box: Tuple[int,int,int,int], mode: str = "contain", scale_factor: float = 1.0) -> int:
+def _paste_into_box(
+    base: Image.Image,
+    img: Image.Image,
+    box: Tuple[int,int,int,int],
+    mode: str = "contain",
+    scale_factor: float = 1.0,
+    resample: Image.Resampling = Image.Resampling.LANCZOS,
+) -> int:
     """
     Pega una imagen en un box.
+    resample: LANCZOS para fotos; NEAREST solo para máscaras/imágenes ya binarias
     Returns: altura real utilizada por la imagen
     """
     x1, y1, x2, y2 = box
     bw, bh = (x2 - x1), (y2 - y1)
 
-    img = img.convert("RGB")
     iw, ih = img.size
 
     if mode == "cover":
         # escala para cubrir y recorta
         scale = max(bw / iw, bh / ih) * scale_factor
-        nw, nh = int(iw * scale), int(ih * scale)
-        resized = img.resize((nw, nh), Image.Resampling.NEAREST)
+    else:
+        # contain - alinear arriba
+        scale = min(bw / iw, bh / ih) * scale_factor
+    nw, nh = int(iw * scale), int(ih * scale)
+
+    # JPEG: decodificar directamente a 1/2, 1/4 o 1/8 si sigue cubriendo (nw, nh).
+    # El tamaño final se calcula antes, así el layout no depende del draft.
+    img.draft("RGB", (nw, nh))
+    if img.mode != "RGB":  # convert() de RGB a RGB solo haría una copia completa
+        img = img.convert("RGB")
+    resized = img.resize((nw, nh), resample)
+
+    if mode == "cover":
         cx, cy = nw // 2, nh // 2
         left = cx - bw // 2
         top = cy - bh // 2
@@ -121,10 +215,6 @@ def _paste_into_box(base: Image.Image, img: Image.Image, box: Tuple[int,int,int,
         base.paste(cropped, (x1, y1))
         return bh  # Siempre usa toda la altura del box
     else:
-        # contain - alinear arriba
-        scale = min(bw / iw, bh / ih) * scale_factor
-        nw, nh = int(iw * scale), int(ih * scale)
-        resized = img.resize((nw, nh), Image.Resampling.NEAREST)
         px = x1 + (bw - nw)//2
         py = y1  # Alinear arriba en lugar de centrar
         base.paste(resized, (px, py))
@@ -150,8 +240,7 @@ def _load_image(image_path: str, title: str = "") -> tuple[Image.Image, str]:
             slug = slugify(title)
         else:
             # Usar hash de la URL
-            url_hash = hashlib.md5(image_path.encode()).hexdigest()[:12]
-            slug = f"cached-{url_hash}"
+            slug = f"cached-{_url_hash(image_path)[:12]}"
         
         # Detectar extensión de la URL
         url_lower = image_path.lower()
@@ -161,6 +250,10 @@ def _load_image(image_path: str, title: str = "") -> tuple[Image.Image, str]:
             ext = '.jpg'  # Default
         
         cache_path = IMAGE_CACHE_DIR / f"{slug}{ext}"
+        if not title and not cache_path.exists():
+            legacy_path = IMAGE_CACHE_DIR / f"cached-{_legacy_url_hash(image_path)[:12]}{ext}"
+            if legacy_path.exists():
+                cache_path = legacy_path
         
         # Si ya está cacheada, usarla
         if cache_path.exists():
@@ -169,15 +262,11 @@ def _load_image(image_path: str, title: str = "") -> tuple[Image.Image, str]:
         
         # Descargar y cachear
         try:
-            response = requests.get(image_path, timeout=10)
-            response.raise_for_status()
-            img_data = response.content
-            
-            # Guardar en cache
-            cache_path.write_bytes(img_data)
+            # Se guarda directamente en cache (sin cargar el cuerpo entero en memoria)
+            _download_to(image_path, cache_path)
             print(f"✓ Imagen descargada y cacheada: {cache_path.name}")
             
-            return Image.open(BytesIO(img_data)), str(cache_path)
+            return Image.open(cache_path), str(cache_path)
         except Exception as e:
             print(f"✗ Error descargando imagen: {e}")
             raise
@@ -185,29 +274,20 @@ def _load_image(image_path: str, title: str = "") -> tuple[Image.Image, str]:
         return Image.open(image_path), image_path
 
 def _remove_white_background(img: Image.Image) -> Image.Image:
-    """Elimina el fondo blanco de una imagen haciendo transparente"""
-    # Asegurar RGBA para transparencia
-    if img.mode != "RGBA":
-        img = img.convert("RGBA")
-    
-    # Obtener datos de píxeles
-    data = list(img.getdata())
-    new_data = []
+    """
+    Elimina el fondo blanco de una imagen haciendo transparente.
+    render_card no la usa: la imagen se compone sobre la cartela blanca y se
+    trama en B/N, así que el alfa solo sirve si se compone sobre otro fondo.
+    """
+    # Asegurar RGBA para transparencia (copia escribible)
+    arr = np.array(img.convert("RGBA"), dtype=np.uint8)
     
-    for pixel in data:
-        r, g, b = pixel[0], pixel[1], pixel[2]
-        alpha = pixel[3] if len(pixel) >= 4 else 255
-        
-        # Si el píxel es blanco o muy cercano (R>235, G>235, B>235)
-        # hacerlo transparente
-        if r > 235 and g > 235 and b > 235:
-            new_data.append((255, 255, 255, 0))  # Transparente
-        else:
-            # Mantener píxel original con su alpha
-            new_data.append((r, g, b, alpha))
+    # Si el píxel es blanco o muy cercano (R>235, G>235, B>235)
+    # hacerlo transparente; el resto mantiene color y alpha
+    white = (arr[..., 0] > 235) & (arr[..., 1] > 235) & (arr[..., 2] > 235)
+    arr[white] = (255, 255, 255, 0)
     
-    img.putdata(new_data)
-    return img
+    return Image.fromarray(arr, mode="RGBA")
 
 def render_card(
     data: dict,
@@ -221,6 +301,8 @@ def render_card(
     
     Returns:
         (imagen_renderizada, ruta_imagen_cacheada)
+        img.info["degraded"] es True si se usó la fuente por defecto de PIL o
+        la imagen falló (placeholder ERROR): no conviene cachear ese render
     """
     # Compatibilidad con valores numéricos antiguos
     if isinstance(dither, int):
@@ -236,6 +318,12 @@ def render_card(
     f_piece = _load_font(50, bold=True)   # Número de pieza muy grande
     f_cap   = _load_font(20, bold=True)   # Título datos técnicos - aumentado
     f_small = _load_font(18, bold=False)  # Datos técnicos - aumentado
+    # _FONTS solo guarda TrueType reales: lo que no esté ahí es el fallback de PIL
+    loaded = _FONTS.values()
+    degraded = not all(
+        any(f is g for g in loaded)
+        for f in (f_title, f_sub, f_sub_sm, f_bul, f_piece, f_cap, f_small)
+    )
 
     # Nº pieza (arriba derecha) - cuadrado
     pn = (data.get("piece_number") or "").strip()
@@ -308,8 +396,9 @@ def render_card(
                 # Convertir a RGBA si no lo es
                 if src.mode != 'RGBA':
                     src = src.convert('RGBA')
-                # Pegar imagen sobre fondo blanco usando alpha como máscara
-                background.paste(src, mask=src.split()[3])  # Canal alpha
+                # Pegar sobre fondo blanco: una imagen RGBA como máscara usa su canal
+                # alpha directamente (sin split(), que copia las 4 bandas)
+                background.paste(src, mask=src)
                 src = background
             
             # Obtener escala de imagen del data
@@ -324,6 +413,7 @@ def render_card(
             import traceback
             traceback.print_exc()
             draw.text((x + 12, y + 10), f"ERROR: {str(e)}", font=f_sub, fill=(200,50,50))
+            degraded = True
             y += IMAGE_BOX_H + 16
     else:
         draw.text((x + 12, y + 10), "IMATGE", font=f_sub, fill=(140,140,140))
@@ -377,73 +467,104 @@ def render_card(
 
     
     # recorta la imagen de img_box y pegala encima de la original
+    # (se trama la cartela entera a propósito: el flood-fill siembra desde el borde
+    # de la cartela y el error difundido recorre márgenes y filas vecinas; tramar
+    # solo el recorte cambiaría el resultado)
     if image_path:
         img_with_dither = ditherea(img)
         img_cropped = img_with_dither.crop((img_box[0], img_box[1], img_box[2], img_box[3]))
         img.paste(img_cropped, (img_box[0], img_box[1]))
+    img.info["degraded"] = degraded
     return img, cached_image_path
 
-def convert_to_tri(img: Image.Image) -> bytes:
-    """Convierte imagen PNG a formato TRI (e-ink de 3 colores) con texto perfecto"""
-    TARGET_W, TARGET_H = W, H
-    
-    # Asegurar tamaño exacto y RGB - NO redimensionar aquí, ya viene del tamaño correcto
-    if img.size != (TARGET_W, TARGET_H):
-        # Si necesita redimensionar, usar NEAREST para preservar texto renderizado
-        img = img.resize((TARGET_W, TARGET_H), resample=Image.Resampling.NEAREST)
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-    
-    arr = np.array(img, dtype=np.uint8)
-    
+def _render_worker_init() -> None:
+    # Precarga las fuentes de render_card una vez por proceso
+    for size, bold in ((52, True), (28, True), (18, False), (22, False), (50, True), (20, True)):
+        _load_font(size, bold=bold)
+
+def _render_one(args: tuple) -> tuple[Image.Image, str | None]:
+    return render_card(*args)
+
+def render_cards_batch(
+    datas: List[dict],
+    image_paths: List[str | None] | None = None,
+    dither: str | int = "none",
+    max_workers: int | None = None,
+) -> List[tuple[Image.Image, str | None]]:
+    """
+    Renderiza varias cartelas en paralelo (un proceso por núcleo).
+    Devuelve [(imagen, ruta_imagen_cacheada)] en el mismo orden que `datas`.
+    """
+    if image_paths is None:
+        image_paths = [d.get("image_path") for d in datas]
+    jobs = [(d, p, dither) for d, p in zip(datas, image_paths)]
+    if len(jobs) <= 1:
+        return [_render_one(j) for j in jobs]
+    workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    # spawn: sin heredar por fork el estado de PIL/FreeType ni la sesión HTTP
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_render_worker_init) as ex:
+        return list(ex.map(_render_one, jobs))
+
+# Filas por bloque en convert_to_tri
+TRI_BLOCK_ROWS = 64
+
+def _tri_block(arr: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Planos TRI empaquetados (negro, rojo) de un bloque de filas RGB uint8"""
     r = arr[:, :, 0]
     g = arr[:, :, 1]
     b = arr[:, :, 2]
     
-    # Calcular luminancia
-    lum = (0.2126 * r.astype(np.float32) + 
-           0.7152 * g.astype(np.float32) + 
-           0.0722 * b.astype(np.float32))
+    # Luminancia Rec.709 exacta en enteros (x10000): sin temporales float;
+    # el producto se hace directamente en int32 sobre los canales uint8
+    k = lambda c, wgt: np.multiply(c, np.int32(wgt), dtype=np.int32)
+    lum = k(r, 2126)
+    lum += k(g, 7152)
+    lum += k(b, 722)
     
     # Detectar rojo (líneas/bordes decorativos)
-    red_strength = r.astype(np.float32) - np.maximum(g, b).astype(np.float32)
+    red_strength = r.astype(np.int16) - np.maximum(g, b)
     is_red = (red_strength > 30) & (r > 100)
     
     # Para texto perfecto: usar umbral duro en píxeles muy oscuros
     # El texto renderizado es (20,20,20) = luminancia ~20
     # Usar umbral en 80 para capturar solo texto nítido
-    is_text = lum < 80
+    is_text = lum < 80 * 10000
     
     # Para grises medios (imágenes): usar umbral normal
-    is_dark_gray = (lum >= 80) & (lum < 160) & (~is_red)
+    is_dark_gray = (lum >= 80 * 10000) & (lum < 160 * 10000) & (~is_red)
     
     # Combinar: texto + algunos grises oscuros
     is_black = is_text | is_dark_gray
     
-    # Empaquetado bit a bit (MSB first)
-    w, h = TARGET_W, TARGET_H
-    bytes_per_row = (w + 7) // 8
+    # Empaquetado bit a bit (MSB first, filas rellenas a byte); negro tiene prioridad
+    return (
+        np.packbits(is_black, axis=1, bitorder="big"),
+        np.packbits(is_red & ~is_black, axis=1, bitorder="big"),
+    )
+
+def convert_to_tri(img: Image.Image) -> bytes:
+    """Convierte imagen PNG a formato TRI (e-ink de 3 colores) con texto perfecto"""
+    TARGET_W, TARGET_H = W, H
     
-    black_plane = bytearray(bytes_per_row * h)
-    red_plane = bytearray(bytes_per_row * h)
+    # Asegurar tamaño exacto y RGB - NO redimensionar aquí, ya viene del tamaño correcto
+    if img.size != (TARGET_W, TARGET_H):
+        # Si necesita redimensionar, usar NEAREST para preservar texto renderizado
+        img = img.resize((TARGET_W, TARGET_H), resample=Image.Resampling.NEAREST)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
     
-    for y in range(h):
-        row_off = y * bytes_per_row
-        for x in range(w):
-            bit = 7 - (x % 8)
-            idx = row_off + (x // 8)
-            
-            if is_black[y, x]:
-                black_plane[idx] |= (1 << bit)
-            elif is_red[y, x]:
-                red_plane[idx] |= (1 << bit)
+    arr = np.asarray(img, dtype=np.uint8)
+    
+    # Clasificación + empaquetado por bloques de filas: las máscaras temporales
+    # de cada bloque caben en caché y se escriben directamente en los planos
+    w, h = TARGET_W, TARGET_H
+    black_plane = np.empty((h, (w + 7) // 8), dtype=np.uint8)
+    red_plane = np.empty_like(black_plane)
+    for y0 in range(0, h, TRI_BLOCK_ROWS):
+        y1 = y0 + TRI_BLOCK_ROWS
+        black_plane[y0:y1], red_plane[y0:y1] = _tri_block(arr[y0:y1])
     
-    # Construir archivo TRI
-    output = BytesIO()
-    output.write(b"TRI1")
-    output.write(struct.pack("<H", w))
-    output.write(struct.pack("<H", h))
-    output.write(black_plane)
-    output.write(red_plane)
-
-    return output.getvalue()
\ No newline at end of file
+    # Construir archivo TRI: cabecera + planos en una única copia (join acepta
+    # los arrays contiguos vía buffer protocol, sin tobytes intermedios)
+    return b"".join((struct.pack("<4sHH", b"TRI1", w, h), black_plane, red_plane))
\ No newline at end of file
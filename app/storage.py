@@ -1,12 +1,22 @@
 from __future__ import annotations
-import json
 import threading
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+from pydantic import TypeAdapter
 
 from .models import CardRecord, CardData
 from .utils import now_iso, new_id, ensure_dir
 
+# Campos de CardData incluidos en el listado ligero (/api/cards)
+LIGHT_FIELDS = ("piece_number", "cabinet_number", "piece_type", "title", "subtitle", "render_path", "image_path")
+# Campos de texto en los que busca `q`
+SEARCH_FIELDS = ("piece_number", "cabinet_number", "name_query", "title", "subtitle", "year")
+
+# Validación en bloque de la lista de cartelas (una llamada a pydantic-core)
+_CARDS_ADAPTER = TypeAdapter(List[CardRecord])
+
 class JsonStore:
     """
     Persistencia en un único fichero JSON:
@@ -16,23 +26,91 @@ class JsonStore:
         self.path = Path(path)
         ensure_dir(self.path.parent)
         self._lock = threading.Lock()
+        # Proyección ligera cacheada: (firma del fichero, [(texto búsqueda, tipo, item)])
+        self._light: Optional[Tuple[Tuple[int, int], List[Tuple[str, str, Dict[str, Any]]]]] = None
+        # Copia en memoria del fichero + índice por id, válida mientras no cambie la firma
+        self._db: Optional[Dict[str, Any]] = None
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._db_sig: Optional[Tuple[int, int]] = None
         if not self.path.exists():
             self._write({"version": 1, "cards": []})
 
     def _read(self) -> Dict[str, Any]:
-        with self.path.open("r", encoding="utf-8") as f:
-            return json.load(f)
+        return orjson.loads(self.path.read_bytes())
 
     def _write(self, obj: Dict[str, Any]) -> None:
         tmp = self.path.with_suffix(".tmp")
-        with tmp.open("w", encoding="utf-8") as f:
-            json.dump(obj, f, ensure_ascii=False, indent=2)
-        tmp.replace(self.path)
+        self._light = None
+        try:
+            # Escritura atómica: fichero temporal + rename (sin fsync)
+            payload = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+            with tmp.open("wb", buffering=1 << 16) as f:
+                f.write(payload)
+            tmp.replace(self.path)
+        except Exception:
+            # la copia en memoria pudo quedar a medias: releer del disco la próxima vez
+            self._db = None
+            raise
+        self._db_sig = self._signature()
+
+    def _load(self) -> Dict[str, Any]:
+        """
+        DB en memoria; solo se re-parsea el fichero si cambió (p. ej. otro proceso).
+        Las mutaciones se hacen sobre esta copia y luego _write. Llamar con el lock tomado.
+        """
+        sig = self._signature()
+        if self._db is None or sig != self._db_sig:
+            self._db = self._read()
+            self._db.setdefault("cards", [])
+            self._by_id = {c.get("id"): c for c in self._db["cards"]}
+            self._db_sig = sig
+        return self._db
+
+    def _signature(self) -> Tuple[int, int]:
+        st = self.path.stat()
+        return st.st_mtime_ns, st.st_size
+
+    def _light_projection(self) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """
+        Proyección ligera de todas las cartelas, ordenada por updated_at desc.
+        Se reconstruye solo si el fichero cambió (escrituras propias u otro proceso).
+        Llamar con el lock tomado.
+        """
+        sig = self._signature()
+        if self._light is not None and self._light[0] == sig:
+            return self._light[1]
+
+        defaults = {k: f.get_default(call_default_factory=True) for k, f in CardData.model_fields.items()}
+        proj = []
+        for c in self._load()["cards"]:
+            d = c.get("data", {})
+            get = lambda k: d.get(k, defaults[k])
+            item = {"id": c["id"], "created_at": c["created_at"], "updated_at": c["updated_at"]}
+            item.update((k, get(k)) for k in LIGHT_FIELDS)
+            hay = " ".join([get(k) or "" for k in SEARCH_FIELDS] + [" ".join(get("bullets") or [])]).lower()
+            proj.append((hay, item["piece_type"], item))
+        proj.sort(key=lambda e: e[2]["updated_at"], reverse=True)
+        self._light = (sig, proj)
+        return proj
+
+    def list_light(self, q: Optional[str] = None, piece_type: Optional[str] = None, skip: int = 0, limit: int = 1000) -> tuple:
+        """Como list_cards pero devuelve dicts ligeros (sin validar con pydantic)"""
+        with self._lock:
+            items = self._light_projection()
+
+        if q:
+            qq = q.lower().strip()
+            items = [e for e in items if qq in e[0]]
+
+        if piece_type and piece_type != "all":
+            items = [e for e in items if e[1] == piece_type]
+
+        total = len(items)
+        return [e[2] for e in items[skip:skip + limit]], total
 
     def list_cards(self, q: Optional[str] = None, piece_type: Optional[str] = None, skip: int = 0, limit: int = 1000) -> tuple:
         with self._lock:
-            db = self._read()
-            cards = [CardRecord.model_validate(c) for c in db.get("cards", [])]
+            cards = _CARDS_ADAPTER.validate_python(self._load()["cards"])
 
         if q:
             qq = q.lower().strip()
@@ -63,10 +141,10 @@ class JsonStore:
 
     def get(self, card_id: str) -> Optional[CardRecord]:
         with self._lock:
-            db = self._read()
-            for c in db.get("cards", []):
-                if c.get("id") == card_id:
-                    return CardRecord.model_validate(c)
+            self._load()
+            c = self._by_id.get(card_id)
+            if c is not None:
+                return CardRecord.model_validate(c)
         return None
 
     def create(self, data: CardData) -> CardRecord:
@@ -77,23 +155,22 @@ class JsonStore:
             data=data
         )
         with self._lock:
-            db = self._read()
-            db.setdefault("cards", []).append(rec.model_dump())
+            db = self._load()
+            c = rec.model_dump()
+            db["cards"].append(c)
+            self._by_id[rec.id] = c
             self._write(db)
         return rec
 
     def update(self, card_id: str, data: CardData) -> Optional[CardRecord]:
         with self._lock:
-            db = self._read()
-            cards = db.get("cards", [])
-            for i, c in enumerate(cards):
-                if c.get("id") == card_id:
-                    c["updated_at"] = now_iso()
-                    c["data"] = data.model_dump()
-                    cards[i] = c
-                    db["cards"] = cards
-                    self._write(db)
-                    return CardRecord.model_validate(c)
+            db = self._load()
+            c = self._by_id.get(card_id)
+            if c is not None:
+                c["updated_at"] = now_iso()
+                c["data"] = data.model_dump()
+                self._write(db)
+                return CardRecord.model_validate(c)
         return None
 
     def duplicate(self, card_id: str) -> Optional[CardRecord]:
@@ -111,12 +188,10 @@ class JsonStore:
 
     def delete(self, card_id: str) -> bool:
         with self._lock:
-            db = self._read()
-            cards = db.get("cards", [])
-            for i, c in enumerate(cards):
-                if c.get("id") == card_id:
-                    cards.pop(i)
-                    db["cards"] = cards
-                    self._write(db)
-                    return True
-        return False
\ No newline at end of file
+            db = self._load()
+            c = self._by_id.pop(card_id, None)
+            if c is not None:
+                db["cards"] = [x for x in db["cards"] if x is not c]
+                self._write(db)
+                return True
+        return False
@@ -1,8 +1,11 @@
 import argparse
+import mmap
 import os
 import struct
 
 import numpy as np
+from numba import njit
+from scipy import ndimage
 from PIL import Image, ImageOps, ImageEnhance
 import matplotlib.pyplot as plt
 
@@ -13,16 +16,8 @@ MAGIC = b"TRI1"
 # Bitpack / unpack
 # ----------------------------
 def pack_1bpp(mask: np.ndarray) -> bytes:
-    """mask: HxW bool, True=1. Pack MSB-first."""
-    h, w = mask.shape
-    bpr = (w + 7) // 8
-    out = np.zeros((h, bpr), dtype=np.uint8)
-    for y in range(h):
-        row = mask[y]
-        for x in range(w):
-            if row[x]:
-                out[y, x // 8] |= (1 << (7 - (x % 8)))
-    return out.tobytes()
+    """mask: HxW bool, True=1. Pack MSB-first (filas rellenas a byte)."""
+    return np.packbits(mask, axis=1, bitorder="big").tobytes()
 
 
 def unpack_1bpp(data: bytes, w: int, h: int) -> np.ndarray:
@@ -32,13 +27,8 @@ def unpack_1bpp(data: bytes, w: int, h: int) -> np.ndarray:
     if len(data) < expected:
         raise ValueError("TRI plane data too short")
     arr = np.frombuffer(data[:expected], dtype=np.uint8).reshape((h, bpr))
-    mask = np.zeros((h, w), dtype=bool)
-    for y in range(h):
-        for x in range(w):
-            byte = arr[y, x // 8]
-            bit = (byte >> (7 - (x % 8))) & 1
-            mask[y, x] = bool(bit)
-    return mask
+    # unpackbits devuelve 0/1 en uint8: vista bool sin copia
+    return np.unpackbits(arr, axis=1, count=w, bitorder="big").view(bool)
 
 
 def write_tri(path: str, w: int, h: int, black_plane: bytes, red_plane: bytes):
@@ -50,65 +40,118 @@ def write_tri(path: str, w: int, h: int, black_plane: bytes, red_plane: bytes):
         f.write(red_plane)
 
 
+# A partir de este tamaño read_tri mapea el fichero en vez de copiar los planos
+TRI_MMAP_MIN_BYTES = 10 * 1024 * 1024
+
+
 def read_tri(path: str):
+    """
+    Devuelve (w, h, black, red). Los planos son bytes, o memoryview de solo
+    lectura sobre un mmap en ficheros grandes (sin copia; válidos para frombuffer).
+    """
     with open(path, "rb") as f:
-        magic = f.read(4)
-        if magic != MAGIC:
-            raise ValueError("Bad TRI magic")
-        w = struct.unpack("<H", f.read(2))[0]
-        h = struct.unpack("<H", f.read(2))[0]
-        bpr = (w + 7) // 8
-        plane_size = bpr * h
-        black = f.read(plane_size)
-        red = f.read(plane_size)
-    return w, h, black, red
+        if os.fstat(f.fileno()).st_size < TRI_MMAP_MIN_BYTES:
+            magic = f.read(4)
+            if magic != MAGIC:
+                raise ValueError("Bad TRI magic")
+            w = struct.unpack("<H", f.read(2))[0]
+            h = struct.unpack("<H", f.read(2))[0]
+            bpr = (w + 7) // 8
+            plane_size = bpr * h
+            black = f.read(plane_size)
+            red = f.read(plane_size)
+            return w, h, black, red
+        # El memoryview mantiene vivo el mapeo aunque se cierre el fichero
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if buf[:4] != MAGIC:
+        raise ValueError("Bad TRI magic")
+    w, h = struct.unpack_from("<HH", buf, 4)
+    bpr = (w + 7) // 8
+    plane_size = bpr * h
+    return w, h, buf[8:8 + plane_size], buf[8 + plane_size:8 + 2 * plane_size]
 
 
 # ----------------------------
 # Dithering (foto)
 # ----------------------------
-def dither_atkinson(gray_u8: np.ndarray) -> np.ndarray:
-    """Atkinson dithering. Returns bool mask (True=black)."""
-    a = gray_u8.astype(np.float32).copy()
+# Constantes float32: mantienen toda la aritmética del kernel en float32,
+# igual que las operaciones numpy originales (sin promoción a float64)
+_F32_0 = np.float32(0.0)
+_F32_128 = np.float32(128.0)
+_F32_255 = np.float32(255.0)
+_F32_8 = np.float32(8.0)
+_F32_16 = np.float32(16.0)
+_F32_7 = np.float32(7.0)
+_F32_5 = np.float32(5.0)
+_F32_3 = np.float32(3.0)
+_F32_1 = np.float32(1.0)
+
+
+@njit("b1[:, :](f4[:, :])", cache=True, boundscheck=False)
+def _atkinson_kernel(a):
     h, w = a.shape
+    black = np.empty((h, w), dtype=np.bool_)
     for y in range(h):
         for x in range(w):
             old = a[y, x]
-            new = 0.0 if old < 128 else 255.0
-            err = (old - new) / 8.0
+            new = _F32_0 if old < _F32_128 else _F32_255
+            err = (old - new) / _F32_8
             a[y, x] = new
-            for dx, dy in [(1, 0), (2, 0), (-1, 1), (0, 1), (1, 1), (0, 2)]:
-                xx = x + dx
-                yy = y + dy
-                if 0 <= xx < w and 0 <= yy < h:
-                    a[yy, xx] += err
-    return a < 128
+            black[y, x] = new < _F32_128
+            # vecinos (1,0) (2,0) (-1,1) (0,1) (1,1) (0,2)
+            if x + 1 < w:
+                a[y, x + 1] += err
+            if x + 2 < w:
+                a[y, x + 2] += err
+            if y + 1 < h:
+                if x > 0:
+                    a[y + 1, x - 1] += err
+                a[y + 1, x] += err
+                if x + 1 < w:
+                    a[y + 1, x + 1] += err
+            if y + 2 < h:
+                a[y + 2, x] += err
+    return black
 
 
-def dither_fs(gray_u8: np.ndarray) -> np.ndarray:
-    """Floyd–Steinberg dithering. Returns bool mask (True=black)."""
-    a = gray_u8.astype(np.float32).copy()
+@njit("b1[:, :](f4[:, :])", cache=True, boundscheck=False)
+def _fs_kernel(a):
     h, w = a.shape
+    black = np.empty((h, w), dtype=np.bool_)
     for y in range(h):
         for x in range(w):
             old = a[y, x]
-            new = 0.0 if old < 128 else 255.0
+            new = _F32_0 if old < _F32_128 else _F32_255
             err = old - new
             a[y, x] = new
+            black[y, x] = new < _F32_128
             if x + 1 < w:
-                a[y, x + 1] += err * 7 / 16
+                a[y, x + 1] += err * _F32_7 / _F32_16
             if y + 1 < h:
                 if x > 0:
-                    a[y + 1, x - 1] += err * 3 / 16
-                a[y + 1, x] += err * 5 / 16
+                    a[y + 1, x - 1] += err * _F32_3 / _F32_16
+                a[y + 1, x] += err * _F32_5 / _F32_16
                 if x + 1 < w:
-                    a[y + 1, x + 1] += err * 1 / 16
-    return a < 128
+                    a[y + 1, x + 1] += err * _F32_1 / _F32_16
+    return black
+
+
+def dither_atkinson(gray_u8: np.ndarray) -> np.ndarray:
+    """Atkinson dithering. Returns bool mask (True=black)."""
+    return _atkinson_kernel(gray_u8.astype(np.float32))
+
+
+def dither_fs(gray_u8: np.ndarray) -> np.ndarray:
+    """Floyd–Steinberg dithering. Returns bool mask (True=black)."""
+    return _fs_kernel(gray_u8.astype(np.float32))
 
 
 # ----------------------------
 # Texto nítido (sin dither)
 # ----------------------------
+_NEIGHBORS_8 = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=np.uint8)
+
+
 def text_threshold_clean(gray_u8: np.ndarray, thresh: int, clean_passes: int = 1) -> np.ndarray:
     """
     Umbral fijo + limpieza rápida:
@@ -119,19 +162,16 @@ def text_threshold_clean(gray_u8: np.ndarray, thresh: int, clean_passes: int = 1
 
     # Limpieza: quita puntos aislados (muy útil para texto)
     # Regla: un pixel negro aislado (con pocos vecinos negros) se vuelve blanco
+    if mask.shape[0] < 3 or mask.shape[1] < 3:
+        return mask  # sin píxeles interiores que limpiar
     for _ in range(clean_passes):
-        m = mask
-        # vecinos 8-conectados (sumamos True como 1)
-        n = (
-            m[:-2, :-2].astype(np.int16) + m[:-2, 1:-1].astype(np.int16) + m[:-2, 2:].astype(np.int16) +
-            m[1:-1, :-2].astype(np.int16) +                         m[1:-1, 2:].astype(np.int16) +
-            m[2:, :-2].astype(np.int16) +  m[2:, 1:-1].astype(np.int16) +  m[2:, 2:].astype(np.int16)
-        )
-        core = m[1:-1, 1:-1].copy()
-        # si un pixel negro tiene <=1 vecino negro, lo quitamos
-        core = np.where((core == 1) & (n <= 1), False, core)
-        mask = m.copy()
-        mask[1:-1, 1:-1] = core
+        # vecinos 8-conectados en una sola convolución 3x3 (centro excluido)
+        n = ndimage.convolve(mask.view(np.uint8), _NEIGHBORS_8, mode="constant", cval=0)
+        # si un pixel negro tiene <=1 vecino negro, lo quitamos (el borde no se toca)
+        isolated = mask & (n <= 1)
+        isolated[[0, -1], :] = False
+        isolated[:, [0, -1]] = False
+        mask = mask & ~isolated
 
     return mask
 
@@ -139,11 +179,20 @@ def text_threshold_clean(gray_u8: np.ndarray, thresh: int, clean_passes: int = 1
 # ----------------------------
 # Rojo (UI roja: líneas, logos, cajas)
 # ----------------------------
+@njit("b1[:, :](u1[:, :, :], i8, i8, i8)", cache=True, boundscheck=False)
+def _red_kernel(rgb, r_min, g_max, b_max):
+    # Una sola pasada por píxel, sin máscaras intermedias por canal; & en vez de
+    # `and` (sin cortocircuito) para que el bucle se vectorice
+    h, w = rgb.shape[0], rgb.shape[1]
+    out = np.empty((h, w), dtype=np.bool_)
+    for y in range(h):
+        for x in range(w):
+            out[y, x] = (rgb[y, x, 0] >= r_min) & (rgb[y, x, 1] <= g_max) & (rgb[y, x, 2] <= b_max)
+    return out
+
+
 def detect_red(rgb: np.ndarray, r_min: int, g_max: int, b_max: int) -> np.ndarray:
-    r = rgb[:, :, 0]
-    g = rgb[:, :, 1]
-    b = rgb[:, :, 2]
-    return (r >= r_min) & (g <= g_max) & (b <= b_max)
+    return _red_kernel(np.asarray(rgb, dtype=np.uint8), r_min, g_max, b_max)
 
 
 # ----------------------------
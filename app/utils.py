@@ -1,42 +1,120 @@
 from __future__ import annotations
+import functools
 import os
 import re
+import threading
 import time
-import uuid
+import unicodedata
 from pathlib import Path
 
+# Patrones compilados una vez (se usan en cada nombre de fichero / slug)
+# Clase negada compilada: una sola pasada en C que ya colapsa cada racha en un "_".
+# Un str.translate con lista blanca + colapso posterior resulta 2-3x más lento
+# (cada carácter es una búsqueda en dict y los no ASCII caen en __missing__), y
+# encode ASCII + bytes.translate + colapso de rachas no gana nada en títulos típicos
+_SAFE_FN_RE = re.compile(r"[^a-zA-Z0-9._-]+")
+# Tabla final del slug (el texto ya es ASCII): a-z0-9 se quedan, espacios y
+# guiones pasan a "_" y todo lo demás se elimina
+_SLUG_FINAL_TABLE = dict.fromkeys(range(128))  # None = eliminar
+_SLUG_FINAL_TABLE.update((ord(c), c) for c in "abcdefghijklmnopqrstuvwxyz0123456789")
+_SLUG_FINAL_TABLE.update((c, "_") for c in range(128) if chr(c).isspace() or chr(c) == "-")
+# Variante para entrada ASCII, que no pasa por lower(): A-Z -> a-z en el mismo
+# translate. (Tras NFKD no vale: "ℌ" da "H", que slugify descarta)
+_SLUG_ASCII_TABLE = {**_SLUG_FINAL_TABLE, **{ord(c): c.lower() for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"}}
+_UNDERSCORE_RUN_RE = re.compile(r"_+")
+# slugify_many separa las entradas con "\0" (slugify lo elimina, aquí se conserva)
+_SLUG_SEP = "\0"
+_SLUG_MANY_TABLE = {**_SLUG_FINAL_TABLE, ord(_SLUG_SEP): ord(_SLUG_SEP)}
+
+# Último segundo formateado (segundo epoch, texto): varias llamadas por segundo
+# reutilizan la cadena. Tupla para que la lectura/escritura sea atómica entre hilos
+_last_iso: tuple[int, str] = (-1, "")
+
 def now_iso() -> str:
     # ISO simple y estable
-    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
+    global _last_iso
+    t = int(time.time())
+    sec, text = _last_iso
+    if t == sec:
+        return text
+    lt = time.localtime(t)
+    text = f"{lt.tm_year:04d}-{lt.tm_mon:02d}-{lt.tm_mday:02d}T{lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
+    _last_iso = (t, text)
+    return text
+
+# Bytes aleatorios precargados para new_id: un os.urandom por cada 1024 ids
+_ID_BYTES = 6
+_RAND_CHUNK = _ID_BYTES * 1024
+_rand_buf = b""
+_rand_pos = 0
+_rand_lock = threading.Lock()
+
+def _reset_rand_buf() -> None:
+    # Tras un fork el hijo no debe reutilizar los bytes del padre (ids duplicados)
+    global _rand_buf, _rand_pos, _rand_lock
+    _rand_buf, _rand_pos = b"", 0
+    _rand_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_rand_buf)
 
 def new_id() -> str:
-    return uuid.uuid4().hex[:12]
+    # 12 caracteres hex (48 bits de os.urandom), sin construir un UUID entero
+    global _rand_buf, _rand_pos
+    with _rand_lock:
+        if _rand_pos >= len(_rand_buf):
+            _rand_buf, _rand_pos = os.urandom(_RAND_CHUNK), 0
+        b = _rand_buf[_rand_pos:_rand_pos + _ID_BYTES]
+        _rand_pos += _ID_BYTES
+    return b.hex()
 
+@functools.lru_cache(maxsize=4096)
 def safe_filename(s: str) -> str:
     s = s.strip()
-    s = re.sub(r"[^a-zA-Z0-9._-]+", "_", s)
+    # Atajo: ASCII alfanumérico puro ya es un nombre válido
+    if s.isascii() and s.isalnum():
+        return s[:120]
+    s = _SAFE_FN_RE.sub("_", s)
     return s[:120] or "file"
 
+@functools.lru_cache(maxsize=4096)
 def slugify(text: str) -> str:
     """Convierte texto a slug para nombres de archivo"""
-    text = text.lower().strip()
-    # Convertir caracteres especiales
-    text = re.sub(r'[áàäâ]', 'a', text)
-    text = re.sub(r'[éèëê]', 'e', text)
-    text = re.sub(r'[íìïî]', 'i', text)
-    text = re.sub(r'[óòöô]', 'o', text)
-    text = re.sub(r'[úùüû]', 'u', text)
-    text = re.sub(r'[ñ]', 'n', text)
-    # Eliminar caracteres no alfanuméricos excepto espacios y guiones
-    text = re.sub(r'[^a-z0-9\s-]', '', text)
-    # Reemplazar espacios con guiones
-    text = re.sub(r'[\s]+', '-', text)
-    # Eliminar guiones múltiples
-    text = re.sub(r'-+', '-', text)
-    # Reemplazar guiones por _
-    text = text.replace('-', '_')
+    text = text.strip()
+    if text.isascii():
+        # Atajo: una sola palabra alfanumérica ya es su propio slug
+        if text.isalnum():
+            return text[:80].lower()
+        table = _SLUG_ASCII_TABLE
+    else:
+        # Quitar diacríticos: NFKD separa letra base + marca combinante y el
+        # encode ASCII descarta las marcas (cubre cualquier alfabeto latino, no solo es)
+        text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+        table = _SLUG_FINAL_TABLE
+    # Espacios/guiones -> _, resto de no alfanuméricos fuera; luego _ múltiples -> uno
+    text = text.translate(table)
+    text = _UNDERSCORE_RUN_RE.sub("_", text)
     # Limitar longitud
     return text[:80] or "unnamed"
 
+def slugify_many(texts: list[str]) -> list[str]:
+    """Como [slugify(t) for t in texts], pero con una sola pasada sobre todas las entradas"""
+    if not texts:
+        return []
+    if any(_SLUG_SEP in t for t in texts):
+        return [slugify(t) for t in texts]
+    joined = _SLUG_SEP.join(t.lower().strip() for t in texts)
+    if not joined.isascii():
+        joined = unicodedata.normalize("NFKD", joined).encode("ascii", "ignore").decode("ascii")
+    joined = joined.translate(_SLUG_MANY_TABLE)
+    joined = _UNDERSCORE_RUN_RE.sub("_", joined)
+    return [p[:80] or "unnamed" for p in joined.split(_SLUG_SEP)]
+
+# Directorios ya creados en este proceso (ensure_dir no repite el mkdir)
+_ENSURED_DIRS: set[str] = set()
+
 def ensure_dir(p: str | Path) -> None:
-    Path(p).mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+    key = os.fspath(p)
+    if key in _ENSURED_DIRS:
+        return
+    os.makedirs(key, exist_ok=True)
+    _ENSURED_DIRS.add(key)
\ No newline at end of file
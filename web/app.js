@@ -540,7 +540,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
     status("Generando sugerencia...");
     try {
-      const response = await api("/api/suggest", {
+      const response = await api("/api/suggest/stream", {
         method: "POST",
         headers: getAuthHeaders(),
         body: JSON.stringify({
@@ -549,7 +549,18 @@ document.addEventListener("DOMContentLoaded", () => {
           piece_number: currentData.piece_number,
         }),
       });
-      const suggestion = await response.json();
+      // Leer el JSON según llega para mostrar progreso
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let text = "";
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        text += decoder.decode(value, { stream: true });
+        status(`Generando sugerencia... (${text.length} caracteres)`);
+      }
+      text += decoder.decode();
+      const suggestion = JSON.parse(text);
       
       // Actualizar los datos con la sugerencia
       if (suggestion.title) currentData.title = suggestion.title;